@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ benchmark
+                                 A QGIS plugin
+ Export qgis project to sps module
+                              -------------------
+        begin                : 2017-02-13
+        copyright            : (C) 2017 by Sweco
+        email                : mortenwinther.fuglsang@sweco.dk
+ ***************************************************************************/
+
+ Micro benchmarks of the parsers and builders on synthetic layer styles,
+ runs without QGIS:
+
+     python benchmark.py -o benchmark.json
+     python benchmark.py -o new.json --compare old.json
+
+ Every style renderer is timed on polygon, line and point layers from one
+ class up to 50000 classes. The timings are written as JSON so runs of two
+ versions can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import traceback
+
+import xmltodict
+import yattag
+import parsers
+import builders
+import exporter
+import spec
+import xmlindent
+
+SIZES = (1, 10, 100, 1000, 10000, 50000)
+LAYER_COUNTS = (1, 10, 100, 1000)
+
+# Seconds a benchmark may take before it is skipped for larger sizes
+BUDGET = 10.0
+
+RENDERERS = {
+    'Singlesymbol': 'singleSymbol',
+    'Graduatedsymbol': 'graduatedSymbol',
+    'Categorizedsymbol': 'categorizedSymbol',
+}
+
+GEOMETRIES = {
+    'POLYGON': ('MultiPolygon', 'fill', 'SimpleFill'),
+    'LINE': ('MultiLineString', 'line', 'SimpleLine'),
+    'POINT': ('Point', 'marker', 'SimpleMarker'),
+}
+
+LINE_STYLES = ('solid', 'dash', 'dot', 'dash dot', 'dash dot dot')
+MARKERS = ('circle', 'square', 'star', 'cross2', 'triangle')
+
+##################################################
+## SYNTHETIC STYLES                             ##
+##################################################
+
+def color(i):
+    return '%d,%d,%d,255' % (i * 7 % 256, i * 13 % 256, i * 17 % 256)
+
+def props(geometry, i):
+    if geometry == 'POLYGON':
+        return [('color', color(i)), ('outline_color', color(i + 1)), ('outline_style', 'solid'),
+                ('outline_width', '0.26'), ('outline_width_unit', 'MM'), ('style', 'solid')]
+    if geometry == 'LINE':
+        return [('capstyle', 'square'), ('line_color', color(i)), ('line_style', LINE_STYLES[i % len(LINE_STYLES)]),
+                ('line_width', '0.5'), ('line_width_unit', 'MM')]
+    return [('angle', '0'), ('color', color(i)), ('name', MARKERS[i % len(MARKERS)]), ('outline_color', '0,0,0,255'),
+            ('outline_width', '0'), ('outline_width_unit', 'MM'), ('size', '2'), ('size_unit', 'MM')]
+
+def symbol(geometry, i):
+    symbol_type, layer_class = GEOMETRIES[geometry][1:]
+    lines = ['      <symbol alpha="1" clip_to_extent="1" type="%s" name="%d">' % (symbol_type, i),
+             '        <layer pass="0" class="%s" locked="0">' % layer_class]
+    for key, value in props(geometry, i):
+        lines.append('          <prop k="%s" v="%s"/>' % (key, value))
+    lines.append('        </layer>')
+    lines.append('      </symbol>')
+    return lines
+
+def qml(renderer, geometry, classes):
+    """A qgis 2 layer style with classes renderer classes."""
+    lines = ["<!DOCTYPE qgis PUBLIC 'http://mrcc.com/qgis.dtd' 'SYSTEM'>",
+             '<qgis version="2.18.0" minimumScale="0" maximumScale="1e+08" hasScaleBasedVisibilityFlag="0">',
+             '  <edittypes>']
+    for field in ('id', 'navn', 'felt'):
+        lines.append('    <edittype widgetv2type="TextEdit" name="%s"/>' % field)
+    lines.append('  </edittypes>')
+    lines.append('  <renderer-v2 attr="felt" forceraster="0" symbollevels="0" type="%s" enableorderby="0">' % RENDERERS[renderer])
+    if renderer == 'Categorizedsymbol':
+        lines.append('    <categories>')
+        for i in range(classes):
+            lines.append('      <category render="true" symbol="%d" value="Værdi %d" label="Værdi %d"/>' % (i, i, i))
+        lines.append('    </categories>')
+    elif renderer == 'Graduatedsymbol':
+        lines.append('    <ranges>')
+        for i in range(classes):
+            lines.append('      <range render="true" symbol="%d" lower="%d.000000" upper="%d.000000" label="%d - %d"/>' % (i, i, i + 1, i, i + 1))
+        lines.append('    </ranges>')
+    lines.append('    <symbols>')
+    for i in range(1 if renderer == 'Singlesymbol' else classes):
+        lines.extend(symbol(geometry, i))
+    lines.append('    </symbols>')
+    lines.append('  </renderer-v2>')
+    lines.append('</qgis>')
+    return '\n'.join(lines)
+
+def connection(geometry, name):
+    return {'dbname': 'gis', 'host': 'localhost', 'port': '5432', 'user': 'gis', 'password': 'gis',
+            'key': 'id', 'srid': '25832', 'type': GEOMETRIES[geometry][0], 'table': 'public.' + name,
+            'geom': 'geom', 'displayname': name, 'layername': name}
+
+## The QGIS datasource uri of a connection
+def layer_source(conn):
+    schema, table = conn['table'].split('.')
+    return ("dbname='%s' host=%s port=%s user='%s' password='%s' sslmode=disable key='%s' srid=%s "
+            'type=%s table="%s"."%s" (%s) sql=' % (conn['dbname'], conn['host'], conn['port'], conn['user'],
+                                                 conn['password'], conn['key'], conn['srid'], conn['type'],
+                                                 schema, table, conn['geom']))
+
+def layer(renderer, geometry, classes, name=None):
+    name = name or renderer.lower() + '_' + geometry.lower()
+    return spec.LayerSpec(name, name, name, renderer, connection(geometry, name), qml(renderer, geometry, classes))
+
+##################################################
+## TIMING                                       ##
+##################################################
+
+def timed(function, repeat, setup=None):
+    """Best and mean wall time of repeat calls of function."""
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = timeit.default_timer()
+        function()
+        times.append(timeit.default_timer() - start)
+    return {'best': min(times), 'mean': sum(times) / len(times)}
+
+class Benchmark(object):
+
+    def __init__(self, repeat, module_path, budget=BUDGET):
+        self.repeat = repeat
+        self.module_path = module_path
+        self.budget = budget
+        self.results = []
+        # benchmarks that went over budget, larger sizes of them are skipped
+        self.slow = set()
+
+    def run(self, name, function, setup=None, **case):
+        result = dict(case)
+        result['benchmark'] = name
+        slow_key = (name, case.get('renderer'), case.get('geometry'))
+        if slow_key in self.slow:
+            result['skipped'] = True
+        else:
+            try:
+                result.update(timed(function, self.repeat, setup))
+            except Exception:
+                result['error'] = traceback.format_exc().splitlines()[-1]
+            if result.get('best', 0) > self.budget:
+                self.slow.add(slow_key)
+        self.results.append(result)
+        if result.get('skipped'):
+            outcome = 'skipped'
+        else:
+            outcome = result.get('error') or '%.4fs' % result['best']
+        sys.stderr.write('%-22s %-18s %-8s %6s  %s\n' % (
+            name, case.get('renderer', ''), case.get('geometry', ''), case.get('classes', case.get('layers', '')),
+            outcome))
+        return result
+
+    def remove(self, path):
+        def setup():
+            if os.path.isfile(path):
+                os.remove(path)
+        return setup
+
+    def style(self, renderer, geometry, classes):
+        """Time every step a layer style goes through on its way to a theme."""
+        layer_spec = layer(renderer, geometry, classes)
+        document = layer_spec.qml
+        case = {'renderer': renderer, 'geometry': geometry, 'classes': classes, 'bytes': len(document)}
+        self.run('xmltodict.parse', lambda: xmltodict.parse(document), **case)
+        self.run('parsers.StyleReader', lambda: parsers.StyleReader().read(document), **case)
+        renderer_element = xmltodict.parse(document)['qgis']['renderer-v2']
+        try:
+            style = parsers.layer_style(document)
+        except Exception:
+            style = None
+        self.run('parsers.' + parsers.STYLE_PARSERS[renderer].__name__,
+                 lambda: parsers.STYLE_PARSERS[renderer](renderer_element), **case)
+        self.run('parsers.layer_style', lambda: parsers.layer_style(document), **case)
+        if style is None:
+            return
+        build = exporter.STYLE_BUILDERS[renderer]
+        theme = builders.theme_path('bench', self.module_path, layer_spec.name)
+        self.run('builders.' + build.__name__,
+                 lambda: build(style['classes'], 'bench', self.module_path, layer_spec),
+                 self.remove(theme), **case)
+        presentation = self.module_path + '/presentations/pres-bench_' + layer_spec.name + '.xml'
+        self.run('builders.presentation',
+                 lambda: builders.presentation(style['fields'], 'bench', self.module_path, layer_spec),
+                 self.remove(presentation), **case)
+        # the theme without its indentation, as yattag.Doc builds documents
+        with open(theme) as f:
+            flat = ''.join(line.strip() for line in f)
+        case['bytes'] = len(flat)
+        self.run('yattag.indent', lambda: yattag.indent(flat), **case)
+        self.run('xmlindent.indent', lambda: xmlindent.indent(flat), **case)
+
+    def module(self, layers):
+        """Time the builders writing the module wide files."""
+        module = spec.ModuleSpec('bench', self.module_path, {'presentations': 'true'})
+        for i in range(layers):
+            geometry = sorted(GEOMETRIES)[i % len(GEOMETRIES)]
+            name = 'lag_%d' % i
+            module.add(spec.LayerSpec(name, name, name, 'Singlesymbol', connection(geometry, name)))
+        case = {'layers': layers}
+        sources = [(layer.id, layer_source(layer.connection)) for layer in module.layers]
+        cache = parsers.SourceCache()
+        self.run('parsers.source', lambda: [parsers.source(layer_source) for layer_id, layer_source in sources], **case)
+        # the dialog opened again on the same project
+        self.run('parsers.SourceCache', lambda: [cache.source(layer_id, layer_source) for layer_id, layer_source in sources],
+                 lambda: [cache.source(layer_id, layer_source) for layer_id, layer_source in sources], **case)
+        self.run('builders.epds', lambda: builders.epds(module), self.remove(self.module_path + '/datasources/datasources.xml'), **case)
+        self.run('builders.target', lambda: builders.target(module), self.remove(self.module_path + '/queries/targetset-bench.xml'), **case)
+        self.run('builders.themegroups', lambda: builders.themegroups(module), self.remove(self.module_path + '/profiles/includes/themegroups.xml'), **case)
+        self.run('builders.themes', lambda: builders.themes(module), self.remove(self.module_path + '/profiles/includes/themes.xml'), **case)
+        self.run('builders.readme', lambda: builders.readme(module), self.remove(self.module_path + '/read.me'), **case)
+
+##################################################
+## RESULTS                                      ##
+##################################################
+
+def key(result):
+    return (result['benchmark'], result.get('renderer'), result.get('geometry'),
+            result.get('classes'), result.get('layers'))
+
+def compare(old, new):
+    """Print the best time of every benchmark of new against old."""
+    before = dict((key(result), result) for result in old['results'])
+    for result in new['results']:
+        previous = before.get(key(result))
+        if previous is None or 'best' not in previous or 'best' not in result:
+            continue
+        ratio = result['best'] / previous['best'] if previous['best'] else 0
+        print('%-22s %-18s %-8s %6s  %.4fs -> %.4fs  x%.2f' % (
+            result['benchmark'], result.get('renderer') or '', result.get('geometry') or '',
+            result.get('classes', result.get('layers')), previous['best'], result['best'], ratio))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the qgis2sps parsers and builders')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='json file the results are written to')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=SIZES, help='numbers of renderer classes')
+    parser.add_argument('-l', '--layers', type=int, nargs='+', default=LAYER_COUNTS, help='numbers of layers in a module')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs of every benchmark, the best is kept')
+    parser.add_argument('-b', '--budget', type=float, default=BUDGET,
+                        help='seconds a benchmark may take before larger sizes of it are skipped')
+    parser.add_argument('--compare', help='earlier results to compare with')
+    args = parser.parse_args(argv)
+    module_path = tempfile.mkdtemp() + '/bench'
+    exporter.make_folders(module_path)
+    benchmark = Benchmark(args.repeat, module_path, args.budget)
+    try:
+        for renderer in sorted(RENDERERS):
+            for geometry in sorted(GEOMETRIES):
+                # a single symbol style always has one class
+                sizes = [1] if renderer == 'Singlesymbol' else args.sizes
+                for classes in sizes:
+                    benchmark.style(renderer, geometry, classes)
+        for layers in args.layers:
+            benchmark.module(layers)
+    finally:
+        shutil.rmtree(os.path.dirname(module_path))
+    results = {
+        'budget': args.budget,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'results': benchmark.results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
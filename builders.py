@@ -1,171 +1,329 @@
 
 # -*- coding: utf-8 -*-
 import os.path
-from qgis.core import QgsMessageLog
-import xmltodict
 import time
 import math
 import os
+import re
 import sys
 reload(sys)
 sys.setdefaultencoding('utf8')
-import codecs
+from cStringIO import StringIO
 path_to_yattag = str(os.path.realpath(__file__)[:-12] + 'yattag')
 sys.path.append(os.path.realpath(__file__)[:-12] + 'yattag')
 from yattag import Doc
-from yattag import indent
+from xmlindent import indent
+import tracing
 
-def epds(input):
-    modulename = input[0]
-    module_path = input[1]
-    qgis_input = input[6]
-    selected_layers = input[2]
+def write(path, result):
+    """Write result to path unless the file already holds exactly these
+    bytes, so files that did not change keep their mtime. Returns True if
+    the file was written.
+    """
+    if isinstance(result, unicode):
+        result = result.encode('utf8')
+    start = time.time()
+    try:
+        if os.path.isfile(path) and os.path.getsize(path) == len(result):
+            with open(path, 'rb') as f:
+                if f.read() == result:
+                    return False
+        with open(path, 'wb') as f:
+            f.write(result)
+        return True
+    finally:
+        tracing.add_time('write', time.time() - start)
 
-    endpoints = []
+class OutputFile(object):
+    """File object the streaming builders write to. A new file is written
+    straight to disk, an existing file is collected in memory and handed to
+    write, so it is only replaced when its content changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.direct = not os.path.isfile(path)
+        if self.direct:
+            self.f = open(path, 'wb')
+        else:
+            self.f = StringIO()
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf8')
+        if self.direct and tracing.active() is not None:
+            start = time.time()
+            self.f.write(data)
+            tracing.add_time('write', time.time() - start)
+        else:
+            self.f.write(data)
+
+    def close(self):
+        if self.direct:
+            start = time.time()
+            self.f.close()
+            tracing.add_time('write', time.time() - start)
+        else:
+            write(self.path, self.f.getvalue())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        elif self.direct:
+            # never leave half a theme behind
+            self.f.close()
+            os.remove(self.path)
+        return False
+
+def quote_name(name):
+    return '.'.join('"' + part.replace('"', '""') + '"' for part in utf8(name).split('.'))
+
+## Columns the theme, presentation and target of a layer read, None when
+## every column is needed
+def layer_columns(layer, presentations):
+    conn = layer.connection
+    columns = [conn['key']]
+    if layer.attribute:
+        if layer.fields is not None and layer.attribute not in layer.fields:
+            # classified by an expression, not a single field
+            return None
+        columns.append(layer.attribute)
+    if presentations:
+        if layer.fields is None:
+            return None
+        columns.extend(layer.fields)
+    columns.append(conn['geom'])
+    unique = []
+    for column in columns:
+        if column not in unique:
+            unique.append(column)
+    return unique
+
+## The table a datasource reads, narrowed to the used columns and the
+## rows of the subset filter of the layer
+def table_source(layer, columns):
+    conn = layer.connection
+    select = '*'
+    if columns is not None:
+        select = ', '.join(quote_name(column) for column in columns)
+    query = 'SELECT ' + select + ' FROM ' + quote_name(conn['table'])
+    if conn.get('sql'):
+        query += ' WHERE ' + utf8(conn['sql'])
+    return '(' + query + ') AS ' + quote_name(layer.name)
+
+## Pool settings of the endpoints, "name=value" pairs separated by commas
+## and written as <name>value</name> in every endpoint
+POOL_SETTING = re.compile(r'[A-Za-z_][A-Za-z0-9_.-]*$')
+
+def pool_settings(text):
+    """Parse the pool option into (name, value) pairs. Raises ValueError for
+    a malformed option.
+    """
+    settings = []
+    for part in (text or '').split(','):
+        if not part.strip():
+            continue
+        name, _, value = part.partition('=')
+        name, value = name.strip(), value.strip()
+        if not POOL_SETTING.match(name) or not value:
+            raise ValueError('Ugyldig pool-indstilling: ' + part)
+        settings.append((name, value))
+    return settings
+
+class Endpoints(object):
+    """The endpoints of a module, one per host, port, database and user.
+    An endpoint is named after its database, endpoints of databases with
+    the same name on other hosts or for other users are numbered.
+    """
+
+    def __init__(self, module_name):
+        self.module_name = module_name
+        self.names = {}
+        self.connections = []
+
+    def key(self, conn):
+        return conn['host'], conn['port'], conn['dbname'], conn['user']
+
+    def name(self, conn):
+        key = self.key(conn)
+        if key not in self.names:
+            name = 'ep_' + self.module_name + '_' + conn['dbname']
+            taken = set(self.names.values())
+            number = 1
+            while name in taken:
+                number += 1
+                name = 'ep_' + self.module_name + '_' + conn['dbname'] + '_' + str(number)
+            self.names[key] = name
+            self.connections.append(conn)
+        return self.names[key]
+
+@tracing.traced
+def epds(module, views=None):
+    """Write the datasources of a module. A layer datasource reads only
+    the columns its module uses and the rows of its subset filter. views
+    holds the extra (datasource, table) pairs of a layer by layer name,
+    read from the same endpoint as the layer itself.
+    """
+    presentations = module.options.get('presentations') == 'true'
+    pool = pool_settings(module.options.get('pool'))
+    modulename = module.name
+    module_path = module.path
+
+    endpoints = Endpoints(modulename)
+    for layer in module.layers:
+        endpoints.name(layer.connection)
     doc, tag, text, line = Doc().ttl()
     doc.asis('<?xml version="1.0" encoding="UTF-8"?>')
     with tag('datasources'):
-        for i in range (0,len(qgis_input)):
-            connection = qgis_input[i]['host'] + ':'+ qgis_input[i]['port'] + '/'+ qgis_input[i]['dbname']
-            if connection not in endpoints:
-                with tag('endpoint', endpointtype='postgis', name='ep_' + modulename + '_'+ qgis_input[i]['dbname']):
-                    with tag('connect'):
-                        text(connection)
-                    with tag('user'):
-                        text(qgis_input[i]['user'])
-                    with tag('pwd'):
-                        text(qgis_input[i]['password'])
-            endpoints.append(connection)
-        for b in range (0,len(qgis_input)):
-            layername = qgis_input[b]['displayname']
-            if layername in selected_layers:
-                with tag('datasource', endpoint = 'ep_' + modulename + '_'+ qgis_input[b]['dbname'], name= 'ds_'  + modulename + '_' + qgis_input[b]['layername']):
-                    with tag('table', geometrycolumn=qgis_input[b]['geom'], name=qgis_input[b]['table'], pkcolumn= qgis_input[b]['key']):
+        for conn in endpoints.connections:
+            with tag('endpoint', endpointtype='postgis', name=endpoints.name(conn)):
+                with tag('connect'):
+                    text(conn['host'] + ':'+ conn['port'] + '/'+ conn['dbname'])
+                with tag('user'):
+                    text(conn['user'])
+                with tag('pwd'):
+                    text(conn['password'])
+                for name, value in pool:
+                    with tag(name):
+                        text(value)
+        for layer in module.layers:
+            conn = layer.connection
+            endpoint = endpoints.name(conn)
+            with tag('datasource', endpoint = endpoint, name= 'ds_'  + modulename + '_' + layer.name):
+                with tag('table', geometrycolumn=conn['geom'], name=table_source(layer, layer_columns(layer, presentations)), pkcolumn= conn['key']):
+                    ''
+            for datasource, table in (views or {}).get(layer.name, ()):
+                with tag('datasource', endpoint = endpoint, name=datasource):
+                    with tag('table', geometrycolumn=conn['geom'], name=table, pkcolumn= conn['key']):
                         ''
-    result = indent(doc.getvalue())
-    f = open(module_path + '/datasources/datasources.xml', 'w')
-    f.write(result)
-    f.close()
+    with OutputFile(module_path + '/datasources/datasources.xml') as f:
+        with tracing.span('indent'):
+            indent(doc.getvalue(), f=f)
     
-def pres(input):
-    name = input[0]
-    path = input[1]
-    layers = input[2]
-    qmls = input[3]
-    for y in range(0,len(qmls)):
-        fields = []
-        with open(qmls[y]) as f:
-            d = xmltodict.parse(f)
-            a = dict(d['qgis']['edittypes'])
-            b = a['edittype']
-            for i in range(0,len(b)):
-                fields.append(b[i]['@name'])
-        doc, tag, text, line = Doc().ttl()
-        doc.asis('<?xml version="1.0" encoding="UTF-8"?>')
-        with tag('presentation'):
-            doc.asis('<text name="'+layers[y]+'" plural="'+layers[y]+'" value="'+layers[y]+'"/>')
-            with tag('columns'):
-                with tag('column', format='heading'):
-                    doc.asis("<label>'"+layers[y]+"'</label>")
-                    doc.asis("<value>'"+layers[y]+"'</value>")
-                for i in range(0, len(fields)):
-                    with tag('column'):
-                        doc.asis("<label>'"+fields[i]+"'</label>")
-                        doc.asis("<value>"+fields[i]+"</value>")
-        result = indent(doc.getvalue())
-        f = open(path + '/presentations/pres-'+name+'_'+layers[y]+'.xml', 'w')
-        f.write(result)
-        f.close()
-        
-def target(input):
-    name = input[0]
-    path = input[1]
-    layers = input[2]
+@tracing.traced
+def presentation(fields, name, path, layer):
+    layer = layer.name
+    doc, tag, text, line = Doc().ttl()
+    doc.asis('<?xml version="1.0" encoding="UTF-8"?>')
+    with tag('presentation'):
+        doc.asis('<text name="'+layer+'" plural="'+layer+'" value="'+layer+'"/>')
+        with tag('columns'):
+            with tag('column', format='heading'):
+                doc.asis("<label>'"+layer+"'</label>")
+                doc.asis("<value>'"+layer+"'</value>")
+            for i in range(0, len(fields)):
+                with tag('column'):
+                    doc.asis("<label>'"+fields[i]+"'</label>")
+                    doc.asis("<value>"+fields[i]+"</value>")
+    with OutputFile(path + '/presentations/pres-'+name+'_'+layer+'.xml') as f:
+        with tracing.span('indent'):
+            indent(doc.getvalue(), f=f)
+
+@tracing.traced
+def target(module):
+    name = module.name
+    path = module.path
+    layers = module.names()
     doc, tag, text, line = Doc().ttl()
     doc.asis('<?xml version="1.0" encoding="UTF-8"?>')
     with tag('targetset', name=name):
         for i in range(0, len(layers)):
             with tag('target', displayname= layers[i], presentation='[module:'+name+'.dir]/presentations/pres-'+name+'_'+layers[i], themecondition='theme-'+name+'_'+layers[i]):
                 doc.asis('<datasource name="ds_'+name+'_'+layers[i] +'"/>')
-    result = indent(doc.getvalue())
-    f = open(path + '/queries/targetset-'+name+'.xml', 'w')
-    f.write(result)
-    f.close()
+    with OutputFile(path + '/queries/targetset-'+name+'.xml') as f:
+        with tracing.span('indent'):
+            indent(doc.getvalue(), f=f)
     
-def themegroups(input):
-    name = input[0]
+@tracing.traced
+def themegroups(module):
+    name = module.name
     doc, tag, text, line = Doc().ttl()
     doc.asis('<?xml version="1.0" encoding="UTF-8"?>')
     with tag('themegroups'):
         doc.stag('themegroup',displayname = name, expanded='false', name = name, type = 'checkbutton')
-    result = indent(doc.getvalue())
-    f = open(input[1] + '/profiles/includes/themegroups.xml', 'w')
-    f.write(result)
-    f.close()
+    with OutputFile(module.path + '/profiles/includes/themegroups.xml') as f:
+        with tracing.span('indent'):
+            indent(doc.getvalue(), f=f)
 
-def themes(input):
-    layers = input[2]
+@tracing.traced
+def themes(module):
+    layers = module.names()
     doc, tag, text, line = Doc().ttl()
     doc.asis('<?xml version="1.0" encoding="UTF-8"?>')
     with tag('themes'):
         for i in range(0, len(layers)):
-            with tag('theme', module= input[0], name = 'theme-'+input[0]+'_' + layers[i]):
+            with tag('theme', module= module.name, name = 'theme-'+module.name+'_' + layers[i]):
                 with tag('themeselector'):
                     with tag('initialstate'):
                         text('available')
                     with tag('group'):
-                        text(input[0])
+                        text(module.name)
                     with tag('displayname'):
                         text(layers[i])
                     with tag('selectable'):
                         text('true')
                 with tag('downloadable'):
                     text('false')
-    result = indent(doc.getvalue())
-    f = open(input[1] + '/profiles/includes/themes.xml', 'w')
-    f.write(result)
-    f.close()
+    with OutputFile(module.path + '/profiles/includes/themes.xml') as f:
+        with tracing.span('indent'):
+            indent(doc.getvalue(), f=f)
     
-def readme(input):
-    file= input[1]+"/read.me"
-    with open(file, "w+") as myfile:
-        myfile.write("===============================================================\n")
-        myfile.write("QGIS2SPS\n")    
-        myfile.write("===============================================================\n")
-        myfile.write('$Date:'+ time.strftime("%d/%m/%Y")+' $\n')
-        myfile.write('$Revision: 1 $\n') 
-        myfile.write('$Author: qgis2sps $\n') 
-        myfile.write("===============================================================\n")
-        myfile.write('\n')
-        myfile.write('--------------------\n') 
-        myfile.write(input[0] +'\n') 
-        myfile.write('--------------------\n') 
-        myfile.write('\n')
-        myfile.write('**Type description here**\n')
-        myfile.write('\n')
-        myfile.write('--------------------\n') 
-        myfile.write('Installation\n') 
-        myfile.write('--------------------\n') 
-        myfile.write('\n')
-        myfile.write('1: Installation\n')
-        myfile.write('\n')
-        myfile.write('1.a:  Copy the module to modules/custom\n')
-        myfile.write('\n')
-        myfile.write('1.b:  Add the following line to the modules file:\n')
-        myfile.write('\n')
-        myfile.write('        <module name="'+input[0]+'" dir="custom/'+input[0]+'" permissionlevel="public" />\n')
-        myfile.write('\n')
-        myfile.write('2:    Include the following resources in your profile:\n')
-        myfile.write('\n')
-        myfile.write('        <include onlychildnodes="true" src="[module:'+input[0]+'.dir]/profiles/includes/themegroups.xml" />\n')
-        myfile.write('        <include onlychildnodes="true" src="[module:'+input[0]+'.dir]/profiles/includes/themes.xml" />\n')
-        myfile.write('\n')
-        myfile.write('3:    Include the following target in relevant targetset files:\n')
-        myfile.write('\n')
-        myfile.write('        <include onlychildnodes="true" src="[module:'+input[0]+'.dir]/queries/targetset-'+input[0]+'.xml" />\n')
-        myfile.write('\n')
-        myfile.write('4:    Modify your themes and presentations where needed - not all QGIS configuration can be translated to Mapserver...')
-        myfile.close()
+@tracing.traced
+def readme(module, notes=None):
+    file= module.path+"/read.me"
+    lines = []
+    lines.append("===============================================================\n")
+    lines.append("QGIS2SPS\n")    
+    lines.append("===============================================================\n")
+    lines.append('$Date:'+ time.strftime("%d/%m/%Y")+' $\n')
+    lines.append('$Revision: 1 $\n') 
+    lines.append('$Author: qgis2sps $\n') 
+    lines.append("===============================================================\n")
+    lines.append('\n')
+    lines.append('--------------------\n') 
+    lines.append(module.name +'\n') 
+    lines.append('--------------------\n') 
+    lines.append('\n')
+    lines.append('**Type description here**\n')
+    lines.append('\n')
+    lines.append('--------------------\n') 
+    lines.append('Installation\n') 
+    lines.append('--------------------\n') 
+    lines.append('\n')
+    lines.append('1: Installation\n')
+    lines.append('\n')
+    lines.append('1.a:  Copy the module to modules/custom\n')
+    lines.append('\n')
+    lines.append('1.b:  Add the following line to the modules file:\n')
+    lines.append('\n')
+    lines.append('        <module name="'+module.name+'" dir="custom/'+module.name+'" permissionlevel="public" />\n')
+    lines.append('\n')
+    lines.append('2:    Include the following resources in your profile:\n')
+    lines.append('\n')
+    lines.append('        <include onlychildnodes="true" src="[module:'+module.name+'.dir]/profiles/includes/themegroups.xml" />\n')
+    lines.append('        <include onlychildnodes="true" src="[module:'+module.name+'.dir]/profiles/includes/themes.xml" />\n')
+    lines.append('\n')
+    lines.append('3:    Include the following target in relevant targetset files:\n')
+    lines.append('\n')
+    lines.append('        <include onlychildnodes="true" src="[module:'+module.name+'.dir]/queries/targetset-'+module.name+'.xml" />\n')
+    lines.append('\n')
+    lines.append('4:    Modify your themes and presentations where needed - not all QGIS configuration can be translated to Mapserver...')
+    noted = [layer for layer in module.layers if notes and notes.get(layer.name)]
+    if noted:
+        lines.append('\n')
+        lines.append('\n')
+        lines.append('--------------------\n')
+        lines.append('Class order\n')
+        lines.append('--------------------\n')
+        for layer in noted:
+            lines.append('\n')
+            lines.append('theme-' + module.name + '_' + layer.name + ':\n')
+            for note in notes[layer.name]:
+                lines.append(utf8(note) + '\n')
+    write(file, ''.join(lines))
 
 def calculatetransparency(colorstring, alpha):
     color_input = str(colorstring)
@@ -173,357 +331,226 @@ def calculatetransparency(colorstring, alpha):
     color_alpha = float((color_input.split(",")[3]))/255
     return int((color_alpha * opacity)*100)
         
-def categorized(styles, module_name, module_path, layer_name, render_type):
-    doc, tag, text, line = Doc().ttl()
-    doc.asis('<?xml version="1.0" encoding="utf-8"?>')
-    with tag('theme'):
-        with tag('cbinfo-metadata'):
-            doc.asis('<param name="copyright-text"></param>')
-        with tag('clientlayers'):
-            with tag('clientlayer'):
-                doc.asis('<singletile>true</singletile>')
-        with tag('layer', datasource= 'ds_'+ module_name + '_'+ layer_name, name= module_name + '_'+ layer_name, type=render_type):
-            for c in range(len(styles)):
-                with tag('class'):
-                    with tag('name'):
-                        encoded_name = styles[c]['value'].encode('utf8').replace('æ', '*ae*').replace('ø', '*oe*').replace('å', '*aa*')
-                        text(encoded_name)
-                    with tag('expression'):
-                        text('(\'['+str(styles[c]['attribute'])+']\' eq \''+str(encoded_name.decode('utf8'))+'\')')
-                    if render_type == 'POLYGON':
-                        with tag('style'):
-                            value = calculatetransparency(styles[c]['color'], styles[c]['alpha'])
-                            with tag('opacity'):
-                                text(str(value))
-                            with tag('color'):
-                                text(' '.join(styles[c]['color'].split(",")[:3]))
-                            if styles[c]['outline_color'].split(",")[3] == '0':
-                                line_opacity = 100
-                            else:
-                                with tag('outlinecolor'):
-                                    encoded_value = ' '.join(styles[c]['outline_color'].split(",")[:3])
-                                    text(encoded_value)
-                                with tag('outlinewidth'):
-                                    width_type = styles[c]['outline_width_unit']
-                                    if width_type == 'MM':
-                                        encoded_value = math.floor(float(styles[c]['outline_width']) * 10)
-                                    else:
-                                        encoded_value = float(styles[c]['outline_width'])
-                                    text(encoded_value)
-
-                    if render_type == 'LINE':
-                        with tag('style'):
-                            value = calculatetransparency(styles[c]['line_color'],styles[c]['alpha'] )
-                            with tag('opacity'):
-                                text(str(value))
-                            with tag('color'):
-                                text(' '.join(styles[c]['line_color'].split(",")[:3]))
-                            with tag('width'):
-                                width_type = styles[c]['line_width_unit']
-                                if width_type == 'MM':
-                                    encoded_value = math.floor(float(styles[c]['line_width']) * 10)
-                                else:
-                                    encoded_value = float(styles[c]['line_width'])
-                                text(encoded_value)
-                            dashing = styles[c]['line_style']
-                            if dashing != 'solid':
-                                with tag('pattern'):
-                                    if dashing == 'dash':
-                                        text('10 4')
-                                    elif dashing == 'dot':
-                                        text('4 4')
-                                    elif dashing == 'dash dot':
-                                        text('10 4 4 4')
-                                    elif dashing == 'dash dot dot':
-                                        text('10 4 4 4 4 2')
-                                    else:
-                                        text('10 4')
-
-                    if render_type == 'POINT':
-                        with tag('style'):
-                            value = calculatetransparency(styles[c]['color'], styles[c]['alpha'])
-                            with tag('opacity'):
-                                text(str(value))
-                            with tag('color'):
-                                text(' '.join(styles[c]['color'].split(",")[:3]))
-                            with tag('size'):
-                                width_type = styles[c]['size_unit']
-                                if width_type == 'MM':
-                                    encoded_value = math.floor(float(styles[c]['size']) * 4)
-                                else:
-                                    encoded_value = float(styles[c]['size'])
-                                text(encoded_value)
-                            if styles[c]['outline_color'].split(",")[3] == '0':
-                                line_opacity = 100
-                            else:
-                                with tag('outlinecolor'):
-                                    encoded_value = ' '.join(styles[c]['outline_color'].split(",")[:3])
-                                    text(encoded_value)
-                                with tag('outlinewidth'):
-                                    width_type = styles[c]['outline_width_unit']
-                                    if width_type == 'MM':
-                                        encoded_value = math.floor(float(styles[c]['outline_width']) * 10)
-                                    else:
-                                        encoded_value = float(styles[c]['outline_width'])
-                                    text(encoded_value)
-                            with tag('symbol'):
-                                symbol = styles[c]['name']
-                                if symbol == 'square':
-                                    text('square')
-                                elif symbol == 'star':
-                                    text('star')
-                                elif symbol == 'cross2':
-                                    text('cross')
-                                else:
-                                    text('circle')
-    result = indent(doc.getvalue())
-    f = open(module_path +'/temp/theme-temp.xml', 'w')
-    f.write(result)
-    f.close()
-    a = codecs.open(module_path +'/themes/theme-'+ module_name + '_'+ layer_name +'.xml', 'a', 'utf-8')
-    f = open(module_path +'/temp/theme-temp.xml', 'r')
-    for line in iter(f):
-        format_line = line.replace('*oe*', 'ø').replace('*ae*', 'æ').replace('*aa*', 'å')
-        if 'layer type=' in line:
-            a.write(format_line.decode('utf8').encode('utf8'))
-            a.write('[datasource:ds_'+module_name + '_'+ layer_name+'.mapfile-datasource]\n')
-        else:
-            a.write(format_line.decode('utf8').encode('utf8'))
-    a.close()
-    f.close()
-    os.remove(module_path +'/temp/theme-temp.xml')
+##################################################
+## THEMES                                       ##
+##################################################
+## Themes are streamed straight to the theme file in one pass, laid out
+## the way yattag.indent laid out the themes built with yattag.Doc.
 
-def graduated(styles, module_name, module_path, layer_name, render_type):
-    doc, tag, text, line = Doc().ttl()
-    doc.asis('<?xml version="1.0" encoding="ISO-8859-1"?>')
-    with tag('theme'):
-        with tag('cbinfo-metadata'):
-            doc.asis('<param name="copyright-text"></param>')
-        with tag('clientlayers'):
-            with tag('clientlayer'):
-                doc.asis('<singletile>true</singletile>')
-        with tag('layer', datasource= 'ds_'+ module_name + '_'+ layer_name, name= module_name + '_'+ layer_name, type=render_type):
-            for c in range (0,len(styles)):
-                with tag('class'):
-                    with tag('name'):
-                        text(str(styles[c]['label']))
-                    with tag('expression'):
-                        text('(['+str(styles[c]['attribute'])+'] ge '+str(styles[c]['lower'])+' and ['+str(styles[c]['attribute'])+'] lt '+str(styles[c]['upper'])+')')
-                    if render_type == 'POLYGON':
-                        with tag('style'):
-                            value = calculatetransparency(styles[c]['color'], styles[c]['alpha'])
-                            with tag('opacity'):
-                                text(str(value))
-                            with tag('color'):
-                                text(' '.join(styles[c]['color'].split(",")[:3]))
-                            if styles[c]['outline_color'].split(",")[3] == '0':
-                                line_opacity = 100
-                            else:
-                                with tag('outlinecolor'):
-                                    encoded_value = ' '.join(styles[c]['outline_color'].split(",")[:3])                     
-                                    text(encoded_value)
-                                with tag('outlinewidth'):
-                                    width_type = styles[c]['outline_width_unit']              
-                                    if width_type == 'MM':
-                                        encoded_value = math.floor(float(styles[c]['outline_width']) * 10)
-                                    else:
-                                        encoded_value = float(styles[c]['outline_width'])
-                                    text(encoded_value)
-                    if render_type == 'LINE':
-                        with tag('style'):
-                            value = calculatetransparency(styles[c]['line_color'],styles[c]['alpha'])
-                            with tag('opacity'):
-                                text(str(value))
-                            with tag('color'):                     
-                                text(' '.join(styles[c]['line_color'].split(",")[:3]))
-                            with tag('width'):
-                                width_type = styles[c]['line_width_unit']              
-                                if width_type == 'MM':
-                                    encoded_value = math.floor(float(styles[c]['line_width']) * 10)
-                                else:
-                                    encoded_value = float(styles[c]['line_width'])
-                                text(encoded_value)
-                            dashing = styles[c]['line_style']
-                            if dashing != 'solid':
-                                with tag('pattern'):
-                                    if dashing == 'dash':
-                                        text('10 4')
-                                    if dashing == 'dot':
-                                        text('4 4')
-                                    if dashing == 'dash dot':
-                                        text('10 4 4 4')
-                                    if dashing == 'dash dot dot':
-                                        text('10 4 4 4 4 2')
-                    if render_type == 'POINT':
-                        with tag('style'):
-                            value = calculatetransparency(styles[c]['color'], styles[c]['alpha'])
-                            with tag('opacity'):
-                                text(str(value))
-                            with tag('color'):                     
-                                text(' '.join(styles[c]['color'].split(",")[:3]))
-                            with tag('size'):
-                                width_type = styles[c]['size_unit']              
-                                if width_type == 'MM':
-                                    encoded_value = math.floor(float(styles[c]['size']) * 4)
-                                else:
-                                    encoded_value = float(styles[c]['size'])
-                                text(encoded_value)
-                            if styles[c]['outline_color'].split(",")[3] == '0':
-                                line_opacity = 100
-                            else:
-                                with tag('outlinecolor'):
-                                    encoded_value = ' '.join(styles[c]['outline_color'].split(",")[:3])                     
-                                    text(encoded_value)
-                                with tag('outlinewidth'):
-                                    width_type = styles[c]['outline_width_unit']              
-                                    if width_type == 'MM':
-                                        encoded_value = math.floor(float(styles[c]['outline_width']) * 10)
-                                    else:
-                                        encoded_value = float(styles[c]['outline_width'])
-                                    text(encoded_value)
-                            with tag('symbol'):
-                                symbol = styles[c]['name']
-                                if symbol == 'square':
-                                    text('square')
-                                elif symbol == 'star':
-                                    text('star')
-                                elif symbol == 'cross2':
-                                    text('cross')
-                                else:
-                                    text('circle')
-    result = indent(doc.getvalue())
-    f = open(module_path +'/temp/theme-temp.xml', 'w')
-    f.write(result)
-    f.close()
-    a = open(module_path +'/themes/theme-'+ module_name + '_'+ layer_name +'.xml', 'a')
-    f = open(module_path +'/temp/theme-temp.xml', 'r')
-    for line in iter(f):
-        if 'layer type=' in line:
-            a.write(line)
-            a.write('[datasource:ds_'+module_name + '_'+ layer_name+'.mapfile-datasource]\n')
-        else:
-            a.write(line)
-    a.close()
-    f.close()
-    os.remove(module_path +'/temp/theme-temp.xml')
+LINE_PATTERNS = {
+    'dash': '10 4',
+    'dot': '4 4',
+    'dash dot': '10 4 4 4',
+    'dash dot dot': '10 4 4 4 4 2',
+}
 
-def singlesymbol(styles, module_name, module_path, layer_name, render_type):
-    doc, tag, text, line = Doc().ttl()
-    doc.asis('<?xml version="1.0" encoding="ISO-8859-1"?>')
-    style = styles[0]
-    with tag('theme'):
-        with tag('cbinfo-metadata'):
-            doc.asis('<param name="copyright-text"></param>')
-        with tag('clientlayers'):
-            with tag('clientlayer'):
-                doc.asis('<singletile>true</singletile>')
-    
-        with tag('layer', datasource= 'ds_' + module_name + '_'+ layer_name, name= module_name + '_'+ layer_name, type=render_type):
-                    if render_type == 'POLYGON':
-                        with tag('class'):
-                            with tag('name'):
-                                text(layer_name)   
-                            with tag('style'):
-                                value = calculatetransparency(style['color'], style['alpha'])
-                                with tag('opacity'):
-                                    text(str(value))
-                                with tag('color'):                     
-                                    text(' '.join(style['color'].split(",")[:3]))
-                                if style['outline_color'].split(",")[3] == '0':
-                                    line_opacity = 100
-                                else:
-                                    with tag('outlinecolor'):
-                                        encoded_value = ' '.join(style['outline_color'].split(",")[:3])                     
-                                        text(encoded_value)
-                                    with tag('outlinewidth'):
-                                        width_type = style['outline_width_unit']              
-                                        if width_type == 'MM':
-                                            encoded_value = math.floor(float(style['outline_width']) * 10)
-                                        else:
-                                            encoded_value = float(style['outline_width'])
-                                        text(encoded_value)
-
-                    if render_type == 'LINE':
-                        with tag('class'):
-                            with tag('name'):
-                                text(layer_name)                   
-                            with tag('style'):
-                                value = calculatetransparency(style['line_color'],style['alpha'])
-                                with tag('opacity'):
-                                    text(str(value))
-                                with tag('color'):                     
-                                    text(' '.join(style['line_color'].split(",")[:3]))
-                                with tag('width'):
-                                    width_type = style['line_width_unit']              
-                                    if width_type == 'MM':
-                                        encoded_value = math.floor(float(style['line_width']) * 10)
-                                    else:
-                                        encoded_value = float(style['line_width'])
-                                    text(encoded_value)
-                                dashing = style['line_style']
-                                if dashing != 'solid':
-                                    with tag('pattern'):
-                                        
-                                        if dashing == 'dash':
-                                            text('10 4')
-                                        if dashing == 'dot':
-                                            text('4 4')
-                                        if dashing == 'dash dot':
-                                            text('10 4 4 4')
-                                        if dashing == 'dash dot dot':
-                                            text('10 4 4 4 4 2')
-
-                    if render_type == 'POINT':
-                        with tag('class'):
-                            with tag('style'):
-                                value = calculatetransparency(style['color'], style['alpha'])
-                                with tag('opacity'):
-                                    text(str(value))
-                                with tag('color'):                     
-                                    text(' '.join(style['color'].split(",")[:3]))
-                                with tag('size'):
-                                    width_type = style['size_unit']              
-                                    if width_type == 'MM':
-                                        encoded_value = math.floor(float(style['size']) * 4)
-                                    else:
-                                        encoded_value = float(style['size'])
-                                    text(encoded_value)
-                                if style['outline_color'].split(",")[3] == '0':
-                                    line_opacity = 100
-                                else:
-                                    with tag('outlinecolor'):
-                                        encoded_value = ' '.join(style['outline_color'].split(",")[:3])                     
-                                        text(encoded_value)
-                                    with tag('outlinewidth'):
-                                        width_type = style['outline_width_unit']              
-                                        if width_type == 'MM':
-                                            encoded_value = math.floor(float(style['outline_width']) * 10)
-                                        else:
-                                            encoded_value = float(style['outline_width'])
-                                        text(encoded_value)
-                                with tag('symbol'):
-                                    symbol = style['name']
-                                    if symbol == 'square':
-                                        text('square')
-                                    elif symbol == 'star':
-                                        text('star')
-                                    elif symbol == 'cross2':
-                                        text('cross')
-                                    else:
-                                        text('circle')
-    result = indent(doc.getvalue())
-    f = open(module_path +'/temp/theme-temp.xml', 'w')
-    f.write(result)
-    f.close()
-    a = open(module_path +'/themes/theme-'+ module_name + '_'+ layer_name +'.xml', 'a')
-    f = open(module_path +'/temp/theme-temp.xml', 'r')
-    
-    for line in iter(f):
-        if 'layer type=' in line:
-            a.write(line)
-            a.write('[datasource:ds_'+module_name + '_'+ layer_name+'.mapfile-datasource]\n')
-        else :
-            a.write(line)
-    a.close()
-    f.close()
-    os.remove(module_path +'/temp/theme-temp.xml')
+# Pattern of unknown line styles in categorized themes
+CATEGORIZED_PATTERN = '10 4'
+
+POINT_SYMBOLS = {
+    'square': 'square',
+    'star': 'star',
+    'cross2': 'cross',
+}
+
+THEME_HEAD = ('<?xml version="1.0" encoding="%s"?>\n'
+              '<theme>\n'
+              '  <cbinfo-metadata>\n'
+              '    <param name="copyright-text"></param>\n'
+              '  </cbinfo-metadata>\n'
+              '  <clientlayers>\n'
+              '    <clientlayer>\n'
+              '      <singletile>true</singletile>\n'
+              '    </clientlayer>\n'
+              '  </clientlayers>')
+
+LAYER_HEAD = ('\n  <layer type="%s" datasource="%s" name="%s"%s>\n'
+              '[datasource:%s.mapfile-datasource]')
+
+LAYER_TAIL = '\n  </layer>'
+
+THEME_TAIL = '\n</theme>'
+
+def utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return str(value)
+
+def escape(value):
+    return utf8(value).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def attr_escape(value):
+    return utf8(value).replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;')
+
+def element(name, value):
+    value = escape(value)
+    if not value.strip():
+        # yattag.indent drops whitespace only text
+        value = ''
+    return '<' + name + '>' + value + '</' + name + '>'
+
+def rgb(colorstring):
+    return ' '.join(colorstring.split(",")[:3])
+
+def size(style, key, factor):
+    if style[key + '_unit'] == 'MM':
+        return str(math.floor(float(style[key]) * factor))
+    return str(float(style[key]))
+
+## The <style> element of a renderer class, kept on one line
+def style_element(render_type, style, pattern=''):
+    parts = ['<style>']
+    if render_type == 'LINE':
+        parts.append(element('opacity', str(calculatetransparency(style['line_color'], style['alpha']))))
+        parts.append(element('color', rgb(style['line_color'])))
+        parts.append(element('width', size(style, 'line_width', 10)))
+        dashing = style['line_style']
+        if dashing != 'solid':
+            parts.append(element('pattern', LINE_PATTERNS.get(dashing, pattern)))
+    elif render_type in ('POLYGON', 'POINT'):
+        parts.append(element('opacity', str(calculatetransparency(style['color'], style['alpha']))))
+        parts.append(element('color', rgb(style['color'])))
+        if render_type == 'POINT':
+            parts.append(element('size', size(style, 'size', 4)))
+        if style['outline_color'].split(",")[3] != '0':
+            parts.append(element('outlinecolor', rgb(style['outline_color'])))
+            parts.append(element('outlinewidth', size(style, 'outline_width', 10)))
+        if render_type == 'POINT':
+            parts.append(element('symbol', POINT_SYMBOLS.get(style['name'], 'circle')))
+    else:
+        return None
+    parts.append('</style>')
+    return ''.join(parts)
+
+class ThemeWriter(object):
+    """Streams the theme of a layer to a file object, one class at a time.
+    bands are the (suffix, scale) layers of a generalized theme, each
+    drawn from the datasource of the layer with the suffix appended and
+    holding the same classes.
+    """
+
+    def __init__(self, f, encoding, module_name, layer, classitem=None, scale=None, bands=None):
+        self.f = f
+        self.datasource = 'ds_' + module_name + '_' + layer.name
+        self.name = module_name + '_' + layer.name
+        self.render_type = layer.render_type
+        self.extra = ''
+        if classitem is not None:
+            self.extra = ' classitem="' + attr_escape(classitem) + '"'
+        if bands is None:
+            bands = [('', scale)]
+        self.bands = bands[1:]
+        # the classes are written again for every further band
+        self.classes = [] if self.bands else None
+        f.write(THEME_HEAD % encoding)
+        self.add_layer(*bands[0])
+
+    def add_layer(self, suffix, scale):
+        datasource = self.datasource + suffix
+        self.f.write(LAYER_HEAD % (attr_escape(self.render_type), attr_escape(datasource),
+                                   attr_escape(self.name + suffix), self.extra, datasource))
+        if scale is not None:
+            self.add_scale(*scale)
+
+    ## Mapserver skips the layer outside its scale band
+    def add_scale(self, minimum, maximum):
+        if minimum:
+            self.f.write('\n    ' + element('minscale', denominator(minimum)))
+        if maximum:
+            self.f.write('\n    ' + element('maxscale', denominator(maximum)))
+
+    def add_class(self, name, expression, style):
+        parts = ['\n    <class>']
+        if name is not None:
+            parts.append('\n      ' + element('name', name))
+        if expression is not None:
+            parts.append('\n      ' + element('expression', expression))
+        if style is not None:
+            parts.append('\n      ' + style)
+        parts.append('\n    </class>')
+        self.f.write(''.join(parts))
+        if self.classes is not None:
+            self.classes.append(''.join(parts))
+
+    def close(self):
+        for suffix, scale in self.bands:
+            self.f.write(LAYER_TAIL)
+            self.add_layer(suffix, scale)
+            self.f.write(''.join(self.classes))
+        self.f.write(LAYER_TAIL + THEME_TAIL)
+
+def denominator(value):
+    return ('%f' % value).rstrip('0').rstrip('.')
+
+def theme_path(module_name, module_path, layer_name):
+    return module_path + '/themes/theme-' + module_name + '_' + layer_name + '.xml'
+
+## Category values Mapserver can compare as numbers, only done for numeric
+## fields as a string field holding "1.50" would then match "1.5"
+NUMBER = re.compile(r'-?(0|[1-9][0-9]*)(\.[0-9]+)?$')
+
+## Values Mapserver reads as plain strings when compared to the classitem,
+## expressions starting with ( / " ' or { mean something else
+def plain_string(value):
+    return value != '' and value == value.strip() and value[0] not in '(/"\'{`'
+
+def category_expression(attribute, values):
+    if len(values) > 1:
+        # categories merged by compaction
+        return '(\'[' + attribute + ']\' in \'' + ','.join(values) + '\')'
+    return '(\'[' + attribute + ']\' eq \'' + values[0] + '\')'
+
+## Expression matched against the classitem of the layer
+def classitem_expression(attribute, values, numeric=False):
+    if len(values) > 1:
+        if all(plain_string(value) and '}' not in value for value in values):
+            return '{' + ','.join(values) + '}'
+    elif numeric and NUMBER.match(values[0]):
+        return '([' + attribute + '] = ' + values[0] + ')'
+    elif plain_string(values[0]):
+        return values[0]
+    return category_expression(attribute, values)
+
+@tracing.traced
+def categorized(styles, module_name, module_path, layer, classitem=False, scale=None, bands=None):
+    """Write a categorized theme. With classitem the attribute is declared
+    once on the layer and the classes match plain strings, lists or, for a
+    numeric field, numbers instead of string comparisons. scale is the (minimum, maximum) scale
+    band of the layer and bands the layers of a generalized theme.
+    """
+    render_type = layer.render_type
+    expression = category_expression
+    attribute = None
+    if classitem and styles:
+        expression = lambda name, values: classitem_expression(name, values, layer.numeric is True)
+        attribute = utf8(styles[0]['attribute'])
+    with OutputFile(theme_path(module_name, module_path, layer.name)) as f:
+        theme = ThemeWriter(f, 'utf-8', module_name, layer, attribute, scale, bands)
+        for style in styles:
+            values = style.get('values') or [utf8(style['value'])]
+            name = ', '.join(values)
+            theme.add_class(name, expression(utf8(style['attribute']), values),
+                            style_element(render_type, style, CATEGORIZED_PATTERN))
+        theme.close()
+
+@tracing.traced
+def graduated(styles, module_name, module_path, layer, scale=None, bands=None):
+    render_type = layer.render_type
+    with OutputFile(theme_path(module_name, module_path, layer.name)) as f:
+        theme = ThemeWriter(f, 'ISO-8859-1', module_name, layer, scale=scale, bands=bands)
+        for style in styles:
+            attribute = utf8(style['attribute'])
+            expression = '([' + attribute + '] ge ' + utf8(style['lower']) + ' and [' + attribute + '] lt ' + utf8(style['upper']) + ')'
+            theme.add_class(utf8(style['label']), expression, style_element(render_type, style))
+        theme.close()
+
+@tracing.traced
+def singlesymbol(styles, module_name, module_path, layer, scale=None, bands=None):
+    render_type = layer.render_type
+    with OutputFile(theme_path(module_name, module_path, layer.name)) as f:
+        theme = ThemeWriter(f, 'ISO-8859-1', module_name, layer, scale=scale, bands=bands)
+        if render_type in ('POLYGON', 'LINE'):
+            theme.add_class(layer.name, None, style_element(render_type, styles[0]))
+        elif render_type == 'POINT':
+            theme.add_class(None, None, style_element(render_type, styles[0]))
+        theme.close()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import builders
+
+##################################################
+## CLASS COMPACTION                             ##
+##################################################
+## Mapserver tries the classes of a layer one by one for every feature,
+## so classes drawn the same way are merged before the theme is written.
+## Two classes are drawn the same way when they render and resolve to the
+## same <style> element.
+
+def style_key(style, render_type, pattern=''):
+    element = builders.style_element(render_type, style, pattern)
+    if element is None:
+        return None
+    return style.get('render'), element
+
+def mergeable_value(value):
+    # a value can go in an "in" list when it can not be mistaken for two
+    # values or for the empty value
+    return value != '' and ',' not in value and value == value.strip()
+
+## Categories with the same style become one class matching all their values
+def categorized(classes, render_type):
+    compacted = []
+    by_style = {}
+    for style in classes:
+        value = builders.utf8(style['value'])
+        key = style_key(style, render_type, builders.CATEGORIZED_PATTERN)
+        if key is None or not mergeable_value(value):
+            compacted.append(style)
+        elif key in by_style:
+            by_style[key]['values'].append(value)
+        else:
+            style = dict(style)
+            style['values'] = [value]
+            by_style[key] = style
+            compacted.append(style)
+    return compacted
+
+def bound(value):
+    return ('%f' % float(value)).rstrip('0').rstrip('.')
+
+def adjacent(lower, upper):
+    try:
+        return float(lower['upper']) == float(upper['lower'])
+    except ValueError:
+        return False
+
+## Adjacent ranges with the same style become one wider range
+def graduated(classes, render_type):
+    compacted = []
+    previous = None
+    for style in classes:
+        key = style_key(style, render_type)
+        if key is not None and key == previous and adjacent(compacted[-1], style):
+            merged = compacted[-1]
+            merged['upper'] = style['upper']
+            merged['label'] = bound(merged['lower']) + ' - ' + bound(merged['upper'])
+        else:
+            compacted.append(dict(style))
+        previous = key
+    return compacted
+
+COMPACTORS = {
+    'Categorizedsymbol': categorized,
+    'Graduatedsymbol': graduated,
+}
+
+def compact(renderer, classes, render_type):
+    """Merge the classes of a parsed layer style that are drawn the same way."""
+    if renderer not in COMPACTORS:
+        return classes
+    return COMPACTORS[renderer](classes, render_type)
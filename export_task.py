@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import Queue
+import traceback
+
+from PyQt4.QtCore import QThread
+
+import exporter
+
+
+class ExportTask(QThread):
+    """Builds a module with exporter.build outside the GUI thread.
+
+    The thread never touches the dialog: theme messages are queued and the
+    latest progress kept, for the GUI thread to fetch in batches while it
+    polls the task. The module must be prepared on the GUI thread, as its
+    styles and value counts are read from the QGIS layers.
+    """
+
+    def __init__(self, module, parent=None):
+        QThread.__init__(self, parent)
+        self.module = module
+        self.messages = Queue.Queue()
+        # (stage, done, total) of the last progress report
+        self.progress = None
+        self.results = None
+        self.error = None
+        self.cancelled = False
+        # True when the build stopped before it was done
+        self.stopped = False
+
+    def run(self):
+        try:
+            self.results = exporter.build(self.module, self.theme_done, self.theme_error,
+                                          self.report, self.is_cancelled)
+        except exporter.Cancelled as cancelled:
+            self.results = cancelled.results
+            self.stopped = True
+        except Exception:
+            self.error = traceback.format_exc()
+
+    def cancel(self):
+        """Stop the build at the next theme or stage."""
+        self.cancelled = True
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def report(self, stage, done, total):
+        self.progress = (stage, done, total)
+
+    def theme_done(self, themename):
+        self.messages.put((themename, None))
+
+    def theme_error(self, themename, error=None):
+        self.messages.put((themename, error or ''))
+
+    def fetch(self):
+        """The (themename, error) messages queued since the last fetch, error
+        is None for a theme that was written.
+        """
+        messages = []
+        while True:
+            try:
+                messages.append(self.messages.get_nowait())
+            except Queue.Empty:
+                return messages
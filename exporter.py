@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import traceback
+from contextlib import contextmanager
+import parsers
+import builders
+import compaction
+import frequency
+import generalize
+import profiling
+import staging
+import tracing
+
+FOLDERS = ('datasources', 'themes', 'presentations', 'profiles', 'profiles/includes', 'queries', 'temp')
+
+MANIFEST = 'qgis2sps-manifest.json'
+MANIFEST_VERSION = 1
+
+# Options that change the theme or presentation of a layer
+LAYER_OPTIONS = ('presentations', 'compact', 'classitem', 'generalize')
+
+COMPATIBLE_TYPES = ('Singlesymbol', 'Categorizedsymbol', 'Graduatedsymbol')
+
+STYLE_BUILDERS = {
+    'Singlesymbol': builders.singlesymbol,
+    'Graduatedsymbol': builders.graduated,
+    'Categorizedsymbol': builders.categorized,
+}
+
+def make_folders(module_path):
+    for folder in ('',) + FOLDERS:
+        try:
+            os.mkdir(module_path + '/' + folder)
+        except:
+            pass
+
+## Keep a copy of a layer style in <module>/qml, only done when asked for
+def write_qml(module_path, layer_name, qml):
+    try:
+        os.mkdir(module_path + '/qml')
+    except:
+        pass
+    pathtoqml = module_path + '/qml/' + layer_name + '.qml'
+    builders.write(pathtoqml, qml)
+    return pathtoqml
+
+## Write the theme of a parsed layer style
+def theme(style, module_name, module_path, layer, options=None):
+    if layer.render_type is None or style['renderer'] not in STYLE_BUILDERS:
+        return
+    build = STYLE_BUILDERS[style['renderer']]
+    kwargs = {}
+    if style['renderer'] == 'Categorizedsymbol' and options and options.get('classitem') == 'true':
+        kwargs['classitem'] = True
+    if style.get('scale') is not None:
+        kwargs['scale'] = style['scale']
+    if options and options.get('generalize') and generalize.generalized(layer):
+        kwargs['bands'] = generalize.theme_bands(generalize.parse_bands(options['generalize']), style.get('scale'))
+    build(style['classes'], module_name, module_path, layer, **kwargs)
+
+def layer_job(job):
+    """Pool worker: parse one layer style once and write its presentation
+    and theme from it. Reports (layer_name, error, notes, spans) so a
+    failing layer never stops the others, notes are the read.me lines of
+    the layer and spans the trace events of the job when tracing.
+    """
+    module_name, module_path, options, layer = job
+    tracer = None
+    if options.get('trace') == 'true':
+        # a worker process has no tracer of its own, the spans go back
+        # with the result
+        tracer = tracing.Tracer()
+        previous = tracing.activate(tracer)
+    try:
+        with tracing.span('layer', layer=layer.name):
+            notes = build_layer(module_name, module_path, options, layer)
+        return layer.name, None, notes, tracer and tracer.events
+    except Exception:
+        return layer.name, traceback.format_exc(), [], tracer and tracer.events
+    finally:
+        if tracer is not None:
+            tracing.activate(previous)
+
+def build_layer(module_name, module_path, options, layer):
+    with tracing.span('parse'):
+        style = parsers.layer_style(layer.qml)
+    if options['presentations'] == 'true':
+        builders.presentation(style['fields'], module_name, module_path, layer)
+    if options.get('compact') == 'true':
+        with tracing.span('compact'):
+            style['classes'] = compaction.compact(style['renderer'], style['classes'], layer.render_type)
+    notes = []
+    if layer.frequencies is not None:
+        attribute = layer.attribute
+        if attribute is None and style['classes']:
+            attribute = style['classes'][0].get('attribute')
+        with tracing.span('reorder'):
+            style['classes'], notes = frequency.reorder(style['renderer'], style['classes'],
+                                                        layer.frequencies, builders.utf8(attribute or ''))
+    theme(style, module_name, module_path, layer, options)
+    return notes
+
+def pool(processes):
+    # Inside QGIS on Windows sys.executable is the QGIS binary, so workers
+    # must be started with the python interpreter QGIS is running on.
+    if sys.platform == 'win32':
+        python = os.path.join(sys.exec_prefix, 'python.exe')
+        if not os.path.isfile(python):
+            return None
+        multiprocessing.set_executable(python)
+    return multiprocessing.Pool(processes)
+
+## Build the presentation and theme of every layer job, spread over a
+## process pool when more than one process is configured
+def build_layers(jobs, processes=1):
+    workers = None
+    if processes > 1 and len(jobs) > 1:
+        workers = pool(min(processes, len(jobs)))
+    if workers is None:
+        for job in jobs:
+            yield layer_job(job)
+        return
+    try:
+        for result in workers.imap(layer_job, jobs):
+            yield result
+    finally:
+        workers.terminate()
+        workers.join()
+
+##################################################
+## INCREMENTAL UPDATE                           ##
+##################################################
+
+def layer_files(module_name, layer_name):
+    return ['themes/theme-' + module_name + '_' + layer_name + '.xml',
+            'presentations/pres-' + module_name + '_' + layer_name + '.xml']
+
+## Fingerprint of everything a layer's theme and presentation is built from
+def fingerprint(module, layer):
+    h = hashlib.sha1()
+    conn = repr(sorted(layer.connection.items()))
+    options = [module.options.get(key) or 'false' for key in LAYER_OPTIONS]
+    parts = [module.name, layer.label()] + options + [conn, layer.qml]
+    if layer.frequencies is not None:
+        parts.append(repr(sorted(layer.frequencies.items())))
+    if module.options.get('classitem') == 'true':
+        # numbers are only matched as numbers in numeric fields
+        parts.append(repr(layer.numeric))
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf8')
+        h.update(part)
+        h.update('\0')
+    return h.hexdigest()
+
+## The manifest holds the fingerprint and the read.me notes of every layer
+def read_manifest(module_path):
+    try:
+        with open(module_path + '/' + MANIFEST) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return {}, {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}, {}
+    return manifest.get('layers', {}), manifest.get('notes', {})
+
+def write_manifest(module_path, layers, notes):
+    manifest = {'version': MANIFEST_VERSION, 'layers': layers}
+    if notes:
+        manifest['notes'] = notes
+    builders.write(module_path + '/' + MANIFEST, json.dumps(manifest, indent=2, sort_keys=True) + '\n')
+
+def unchanged(module_path, module_name, layer_name, fingerprint, presentation, manifest):
+    if manifest.get(layer_name) != fingerprint:
+        return False
+    files = layer_files(module_name, layer_name)
+    if not presentation:
+        files = files[:1]
+    return all(os.path.isfile(module_path + '/' + name) for name in files)
+
+## Remove themes and presentations of layers that left the module
+def remove_layers(module_path, module_name, layer_names):
+    for layer_name in layer_names:
+        for name in layer_files(module_name, layer_name):
+            if os.path.isfile(module_path + '/' + name):
+                os.remove(module_path + '/' + name)
+
+##################################################
+## MODULE                                       ##
+##################################################
+
+# Stages of a build in the order they are reported to its progress callback,
+# the presentation of a layer is written with its theme
+STAGES = ('datasources', 'themes', 'targets', 'includes', 'read.me')
+
+class Cancelled(Exception):
+    """Raised by build when it is cancelled, results holds the (layer_name,
+    error) pairs of the themes finished before.
+    """
+
+    def __init__(self, results):
+        Exception.__init__(self, 'Annulleret')
+        self.results = results
+
+# Trace of a build with the trace option, in the module folder
+TRACE_FILE = 'temp/qgis2sps-trace.json'
+
+# Profiles of a build with the profile option, in the module folder
+PROFILE_FOLDER = 'temp/profile'
+
+@contextmanager
+def stage(name, profiler=None, **args):
+    with tracing.span(name, **args):
+        if profiler is None:
+            yield
+        else:
+            with profiler.stage(name):
+                yield
+
+## Write a complete module from its specification
+def build(module, theme_done=None, theme_error=None, progress=None, cancelled=None):
+    """Build datasources, themes and the optional presentations, targets and
+    includes for a ModuleSpec. Returns a list with a (layer_name, error)
+    pair per theme, error is None for themes that were written or already
+    up to date.
+
+    progress is called with the stage, the units of it done and its total
+    units as every stage starts and as every theme is done. cancelled is
+    polled at the same points, when it returns True the build stops and
+    raises Cancelled. A cancelled update is published with a manifest
+    holding the themes finished until then, so the next update picks up
+    where the build stopped. Any other cancelled build is discarded.
+
+    With the update option an existing module is updated in place: only
+    layers whose fingerprint changed since the last build are rebuilt, and
+    files are only rewritten when their content changed.
+
+    With the generalize option polygon and line themes switch to simplified
+    copies of their tables by scale, and the SQL creating the copies is
+    written to the sql folder of the module, one script per endpoint.
+
+    With the trace option the timing spans of the build are written to
+    trace_file(module.path, module.name), see tracing.summary. With the profile option,
+    or the environment variable profiling.PROFILE_VARIABLE set, every stage
+    is profiled to PROFILE_FOLDER in the module. The themes are then built
+    in this process, so their profile covers the layer jobs.
+
+    The module is built in a local staging folder from a copy of the
+    existing module and published to module.path when the build is done,
+    or when an update is cancelled, see staging.Staging. Only the files
+    that changed are written to an existing module. A failed build leaves
+    module.path as it was. The folders and the qml copies asked for are
+    made in the staging folder too.
+    """
+    if module.options.get('trace') != 'true':
+        return build_published(module, theme_done, theme_error, progress, cancelled)
+    tracer = tracing.Tracer()
+    previous = tracing.activate(tracer)
+    try:
+        with tracing.span('build', module=module.name, layers=len(module.layers)):
+            return build_published(module, theme_done, theme_error, progress, cancelled)
+    finally:
+        tracing.activate(previous)
+        tracer.write(trace_file(module.path, module.name))
+
+## The trace of a failed or cancelled new module is kept in the temp
+## folder of the system, as its staging folder is gone
+def trace_file(module_path, module_name):
+    if os.path.isdir(module_path + '/' + os.path.dirname(TRACE_FILE)):
+        return module_path + '/' + TRACE_FILE
+    return os.path.join(tempfile.gettempdir(), 'qgis2sps-trace-' + module_name + '.json')
+
+def build_published(module, theme_done, theme_error, progress, cancelled):
+    target = module.path
+    staged = staging.Staging(target)
+    module.path = staged.path
+    try:
+        results = build_staged(module, theme_done, theme_error, progress, cancelled)
+    except Cancelled:
+        if module.options.get('update') == 'true':
+            with tracing.span('publish'):
+                staged.publish()
+        else:
+            # a new module is never left half built
+            staged.discard()
+        raise
+    except:
+        staged.discard()
+        raise
+    finally:
+        module.path = target
+    with tracing.span('publish'):
+        staged.publish()
+    return results
+
+def build_staged(module, theme_done, theme_error, progress, cancelled):
+    make_folders(module.path)
+    if module.options.get('qml') == 'true':
+        for layer in module.layers:
+            write_qml(module.path, layer.name, layer.qml)
+    profiler = None
+    if profiling.enabled(module.options):
+        profiler = profiling.Profiler(module.path + '/' + PROFILE_FOLDER)
+    return build_stages(module, theme_done, theme_error, progress, cancelled, profiler)
+
+def build_stages(module, theme_done, theme_error, progress, cancelled, profiler=None):
+    options = module.options
+    update = options.get('update') == 'true'
+    manifest, manifest_notes = {}, {}
+    if update:
+        manifest, manifest_notes = read_manifest(module.path)
+    presentation = options['presentations'] == 'true'
+    fingerprints = {}
+    notes = {}
+    jobs = []
+    results = []
+
+    def report(layer_name, error):
+        results.append((layer_name, error))
+        if error is None:
+            if theme_done is not None:
+                theme_done(str(layer_name))
+        elif theme_error is not None:
+            theme_error(str(layer_name), error)
+
+    def step(stage, done=0, total=1):
+        if cancelled is not None and cancelled():
+            raise Cancelled(results)
+        if progress is not None:
+            progress(stage, done, total)
+
+    with stage('fingerprints', profiler):
+        for layer in module.layers:
+            fingerprints[layer.name] = fingerprint(module, layer)
+            if update and unchanged(module.path, module.name, layer.name, fingerprints[layer.name], presentation, manifest):
+                if manifest_notes.get(layer.name):
+                    notes[layer.name] = manifest_notes[layer.name]
+                report(layer.name, None)
+            else:
+                jobs.append((module.name, module.path, options, layer))
+    try:
+        step('datasources')
+        with stage('datasources', profiler):
+            removed = [layer_name for layer_name in manifest if layer_name not in module.by_name]
+            remove_layers(module.path, module.name, removed)
+            bands = generalize.parse_bands(options.get('generalize'))
+            builders.epds(module, generalize.views(module, bands))
+            generalize.write_scripts(module, bands)
+        step('themes', len(results), len(module.layers))
+        with stage('themes', profiler, layers=len(jobs)):
+            layers = build_layers(jobs, 1 if profiler else options.get('processes', 1))
+            try:
+                for layer_name, error, layer_notes, spans in layers:
+                    if spans and tracing.active() is not None:
+                        tracing.active().events.extend(spans)
+                    if layer_notes:
+                        notes[layer_name] = layer_notes
+                    report(layer_name, error)
+                    step('themes', len(results), len(module.layers))
+            finally:
+                # stops the process pool when the build is cancelled
+                layers.close()
+        if options['targets'] == 'true':
+            step('targets')
+            with stage('targets', profiler):
+                builders.target(module)
+        if options['include'] == 'true':
+            step('includes')
+            with stage('includes', profiler):
+                builders.themegroups(module)
+                builders.themes(module)
+        if not update or jobs or removed or not os.path.isfile(module.path + '/read.me'):
+            step('read.me')
+            with stage('read.me', profiler):
+                builders.readme(module, notes)
+    finally:
+        with stage('manifest', profiler):
+            write_manifest(module.path, dict((layer_name, fingerprints[layer_name]) for layer_name, error in results if error is None), notes)
+    return results
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import bisect
+import json
+
+import builders
+
+# Number of classes listed in read.me for every reordered theme
+NOTED_CLASSES = 20
+
+##################################################
+## VALUE FREQUENCIES                            ##
+##################################################
+## Mapserver stops at the first class that matches a feature, so classes
+## of values that are common in the data are written first. Frequencies
+## map the values of the classification attribute, as strings, to the
+## number of features having them.
+
+def load(path):
+    """Frequencies of a statistics file: a json object with the value
+    counts of each layer by its transformed name.
+    """
+    with open(path) as f:
+        layers = json.load(f)
+    return dict((builders.utf8(name), normalize(counts)) for name, counts in layers.items())
+
+def value_key(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return builders.utf8(value)
+
+def normalize(counts):
+    return dict((value_key(value), int(count)) for value, count in counts.items())
+
+def count_values(connection, table, attribute, subset=None):
+    """Count the values of attribute in a database table through a DB-API
+    connection, only in the rows matching the subset filter when given.
+    NULL values are left out.
+    """
+    attribute = builders.quote_name(attribute)
+    where = attribute + ' IS NOT NULL'
+    if subset:
+        where = '(' + subset + ') AND ' + where
+    cursor = connection.cursor()
+    try:
+        cursor.execute('SELECT ' + attribute + ', COUNT(*) FROM ' + builders.quote_name(table) +
+                       ' WHERE ' + where + ' GROUP BY ' + attribute)
+        return dict((value_key(value), int(count)) for value, count in cursor.fetchall())
+    finally:
+        cursor.close()
+
+def connect_postgis(conn):
+    # psycopg2 is only needed when frequencies are read from postgis
+    import psycopg2
+    return psycopg2.connect(host=conn['host'], port=conn['port'], dbname=conn['dbname'],
+                            user=conn['user'], password=conn['password'])
+
+def query(module, connect=connect_postgis):
+    """Set the frequencies of the categorized and graduated layers of a
+    module from their database, connect opens a DB-API connection for the
+    connection dict of a layer.
+    """
+    for layer in module.layers:
+        if layer.attribute is None or layer.renderer not in REORDERS:
+            continue
+        connection = connect(layer.connection)
+        try:
+            layer.frequencies = count_values(connection, layer.connection['table'], layer.attribute,
+                                             layer.connection.get('sql'))
+        finally:
+            connection.close()
+
+##################################################
+## CLASS ORDER                                  ##
+##################################################
+
+def category_count(style, frequencies):
+    values = style.get('values') or [builders.utf8(style['value'])]
+    return sum(frequencies.get(value, 0) for value in values)
+
+## Category values are matched exactly, so categories never match the same
+## feature and any order gives the same result
+def categorized(classes, frequencies):
+    return [(category_count(style, frequencies), style) for style in classes]
+
+## Ranges can only be reordered when no two of them overlap
+def graduated(classes, frequencies):
+    try:
+        bounds = sorted((float(style['lower']), float(style['upper'])) for style in classes)
+    except ValueError:
+        return None
+    for (lower, upper), (next_lower, next_upper) in zip(bounds, bounds[1:]):
+        if next_lower < upper:
+            return None
+    numbers = []
+    for value, count in frequencies.items():
+        try:
+            numbers.append((float(value), count))
+        except ValueError:
+            pass
+    numbers.sort()
+    values = [value for value, count in numbers]
+    running = [0]
+    for value, count in numbers:
+        running.append(running[-1] + count)
+    counted = []
+    for style in classes:
+        # same bounds as the expression: ge lower and lt upper
+        first = bisect.bisect_left(values, float(style['lower']))
+        last = bisect.bisect_left(values, float(style['upper']))
+        counted.append((running[last] - running[first], style))
+    return counted
+
+REORDERS = {
+    'Categorizedsymbol': categorized,
+    'Graduatedsymbol': graduated,
+}
+
+def class_name(style):
+    if 'values' in style:
+        return ', '.join(style['values'])
+    return builders.utf8(style.get('label', style.get('value')))
+
+def reorder(renderer, classes, frequencies, attribute):
+    """Sort the classes of a parsed layer style with the most frequent
+    first. Returns the classes and the lines recorded in read.me.
+    """
+    if renderer not in REORDERS or not classes:
+        return classes, []
+    counted = REORDERS[renderer](classes, frequencies)
+    if counted is None:
+        return classes, ['Classes kept in QGIS order, the ranges of ' + attribute + ' overlap']
+    # sorted is stable, classes with the same count keep their QGIS order
+    counted = sorted(counted, key=lambda pair: -pair[0])
+    notes = ['Classes ordered by the frequency of ' + attribute + ', most frequent first:']
+    for count, style in counted[:NOTED_CLASSES]:
+        notes.append('    ' + class_name(style) + ': ' + str(count))
+    if len(counted) > NOTED_CLASSES:
+        notes.append('    ... and ' + str(len(counted) - NOTED_CLASSES) + ' more classes')
+    return [style for count, style in counted], notes
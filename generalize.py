@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+
+import builders
+
+# Map distance geometries are simplified by when a band gives no
+# tolerance: 0.2 mm at the scale the band starts at, in metres
+TOLERANCE_PER_SCALE = 0.0002
+
+# Only lines and polygons carry enough vertices to be worth simplifying
+RENDER_TYPES = ('POLYGON', 'LINE')
+
+# Longest identifier postgres keeps, longer names are cut
+IDENTIFIER_LENGTH = 63
+
+##################################################
+## SCALE BANDS                                  ##
+##################################################
+## With the generalize option a polygon or line theme switches to a
+## simplified copy of its table beyond each configured scale. The option
+## is a comma separated list of scale denominators, each optionally
+## followed by the simplification tolerance in the units of the layer
+## coordinate system, e.g. "25000:5,100000:25".
+
+def parse_bands(text):
+    """Parse the generalize option into (scale, tolerance) pairs sorted by
+    scale. Raises ValueError for a malformed option.
+    """
+    bands = {}
+    for part in (text or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        scale, _, tolerance = part.partition(':')
+        scale = int(scale)
+        if tolerance.strip():
+            tolerance = float(tolerance)
+        else:
+            tolerance = scale * TOLERANCE_PER_SCALE
+        if scale <= 0 or tolerance <= 0:
+            raise ValueError('Ugyldigt skalainterval: ' + part)
+        bands[scale] = tolerance
+    return sorted(bands.items())
+
+def generalized(layer):
+    if layer.render_type not in RENDER_TYPES:
+        return False
+    # a layer classified by an expression reads columns the views leave out,
+    # it keeps the full geometry at every scale
+    return not (layer.attribute and layer.fields is not None and layer.attribute not in layer.fields)
+
+def suffix(scale):
+    return '_' + str(scale)
+
+## Datasource of the layer at a scale band, the full geometry below the
+## first band
+def datasource(module_name, layer_name, scale=None):
+    name = 'ds_' + module_name + '_' + layer_name
+    if scale is not None:
+        name += suffix(scale)
+    return name
+
+## Layers on the same table differ by their filter and attribute, so every
+## layer of a module gets views of its own
+def view_name(table, module_name, layer_name, scale):
+    schema, dot, name = table.rpartition('.')
+    name = builders.utf8(name + '_' + module_name + '_' + layer_name + '_gen' + str(scale))
+    if len(name) > IDENTIFIER_LENGTH:
+        # cut names keep a digest of the full name to stay apart
+        digest = hashlib.sha1(name).hexdigest()[:8]
+        name = name[:IDENTIFIER_LENGTH - len(digest) - 1] + '_' + digest
+    return builders.utf8(schema) + dot + name
+
+def views(module, bands):
+    """The (datasource, table) pairs of the simplified copies of every
+    generalized layer of a module, by layer name.
+    """
+    layers = {}
+    for layer in module.layers:
+        if generalized(layer):
+            layers[layer.name] = [(datasource(module.name, layer.name, scale),
+                                   view_name(layer.connection['table'], module.name, layer.name, scale))
+                                  for scale, tolerance in bands]
+    return layers
+
+def theme_bands(bands, scale=None):
+    """The (suffix, (minimum, maximum)) theme layers of a layer drawn from
+    the full geometry below the first band and from each simplified copy
+    above it, cut to the scale band of the layer. 0 is no limit.
+    """
+    lowest, highest = scale or (0, 0)
+    edges = [0] + [band_scale for band_scale, tolerance in bands]
+    layers = []
+    for i, start in enumerate(edges):
+        end = edges[i + 1] if i + 1 < len(edges) else 0
+        minimum = max(start, lowest)
+        if not highest:
+            maximum = end
+        elif not end:
+            maximum = highest
+        else:
+            maximum = min(end, highest)
+        if maximum and maximum <= minimum:
+            continue
+        layers.append((suffix(start) if start else '', (minimum, maximum)))
+    return layers
+
+##################################################
+## SQL SCRIPT                                   ##
+##################################################
+
+def layer_views(module_name, layer, bands):
+    conn = layer.connection
+    columns = [conn['key']]
+    if layer.attribute and layer.attribute not in columns and layer.attribute != conn['geom']:
+        columns.append(layer.attribute)
+    select = ', '.join(builders.quote_name(column) for column in columns)
+    geom = builders.quote_name(conn['geom'])
+    lines = ['-- ' + builders.utf8(conn['displayname']) + ' (' + conn['dbname'] + ': ' + conn['table'] + ')']
+    for scale, tolerance in bands:
+        view = view_name(conn['table'], module_name, layer.name, scale)
+        lines.append('DROP MATERIALIZED VIEW IF EXISTS ' + builders.quote_name(view) + ';')
+        lines.append('CREATE MATERIALIZED VIEW ' + builders.quote_name(view) + ' AS')
+        lines.append('  SELECT ' + select + ', ST_SimplifyPreserveTopology(' + geom + ', ' + repr(tolerance) + ') AS ' + geom)
+        lines.append('  FROM ' + builders.quote_name(conn['table']))
+        if conn.get('sql'):
+            lines.append('  WHERE (' + builders.utf8(conn['sql']) + ') AND ' + geom + ' IS NOT NULL;')
+        else:
+            lines.append('  WHERE ' + geom + ' IS NOT NULL;')
+        lines.append('CREATE UNIQUE INDEX ON ' + builders.quote_name(view) + ' (' + builders.quote_name(conn['key']) + ');')
+        lines.append('CREATE INDEX ON ' + builders.quote_name(view) + ' USING GIST (' + geom + ');')
+    return lines
+
+def script(module_name, endpoint, layers, bands):
+    """SQL creating a simplified materialized view of layers, all read
+    from one endpoint, for each scale band.
+    """
+    conn = layers[0].connection
+    lines = ['-- Generalized geometry for module ' + module_name + ', endpoint ' + endpoint,
+             '-- Run against database ' + conn['dbname'] + ' on ' + conn['host'] + ':' + conn['port'] +
+             ' before the module is used,',
+             '-- and REFRESH MATERIALIZED VIEW when the layer tables change.',
+             'BEGIN;']
+    for layer in layers:
+        lines.append('')
+        lines.extend(layer_views(module_name, layer, bands))
+    lines.extend(['', 'COMMIT;', ''])
+    return '\n'.join(lines)
+
+def scripts(module, bands):
+    """The SQL script of every endpoint with generalized layers, by
+    endpoint name. A module can read from several databases and each
+    script only touches the tables of its own.
+    """
+    endpoints = builders.Endpoints(module.name)
+    layers = {}
+    for layer in module.layers:
+        # every layer is named, so endpoints are numbered as in datasources.xml
+        endpoint = endpoints.name(layer.connection)
+        if generalized(layer):
+            layers.setdefault(endpoint, []).append(layer)
+    return dict((endpoint, script(module.name, endpoint, endpoint_layers, bands))
+                for endpoint, endpoint_layers in layers.items())
+
+SCRIPT_PREFIX = 'generalize-'
+
+def script_path(module, endpoint):
+    return module.path + '/sql/' + SCRIPT_PREFIX + endpoint + '.sql'
+
+def write_scripts(module, bands):
+    """Write the scripts of the bands, none without bands, and remove the
+    scripts of endpoints and bands the module no longer has.
+    """
+    written = set()
+    if bands:
+        try:
+            os.mkdir(module.path + '/sql')
+        except OSError:
+            pass
+        for endpoint, text in scripts(module, bands).items():
+            builders.write(script_path(module, endpoint), text)
+            written.add(os.path.basename(script_path(module, endpoint)))
+    if not os.path.isdir(module.path + '/sql'):
+        return
+    for name in os.listdir(module.path + '/sql'):
+        if name.startswith(SCRIPT_PREFIX) and name.endswith('.sql') and name not in written:
+            os.remove(module.path + '/sql/' + name)
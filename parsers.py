@@ -1,19 +1,334 @@
 # -*- coding: utf-8 -*-
-import xmltodict
+from xml.parsers import expat
 
+##################################################
+## STYLE PARSERS                                ##
+##################################################
+## A layer style is read once by layer_style, the parsers for the
+## renderer classes get the renderer-v2 element in the shape xmltodict
+## gives it.
 
-def singlesymbol(self, qml):
-    with open(qml) as f:
-        styler = []
-        style = {}
-        parsed = xmltodict.parse(f)
-        renderer = dict(parsed['qgis']['renderer-v2']['symbols']['symbol'])
-        style['alpha'] = renderer['@alpha']
-        layer = dict(parsed['qgis']['renderer-v2']['symbols']['symbol']['layer'])
+## Elements with a single child are parsed to a dict instead of a list
+def as_list(value):
+    if isinstance(value, list):
+        return value
+    return [value]
 
-        for i in range(0, len(layer['prop'])):
-            style[str(layer['prop'][i]['@k'])] = str(layer['prop'][i]['@v'])
+## Symbols of a renderer by name, built once so every class finds its
+## symbol without scanning all symbols
+def symbol_index(renderer):
+    index = {}
+    for symbol in as_list(renderer['symbols']['symbol']):
+        index.setdefault(str(symbol['@name']), []).append(symbol)
+    return index
 
-        styler.append(style)
+def symbol_props(style, symbol):
+    style['alpha'] = str(symbol['@alpha'])
+    for prop in as_list(symbol['layer']['prop']):
+        style[str(prop['@k'])] = str(prop['@v'])
 
-    return styler
\ No newline at end of file
+## Catogorized style parser
+def categorized(renderer):
+    styler = []
+    symbols = symbol_index(renderer)
+    attribute = str(renderer['@attr'])
+    for category in as_list(renderer['categories']['category']):
+        name = str(category['@symbol'])
+        for symbol in symbols.get(name, ()):
+            style = {}
+            style['pair'] = name + ',' + name
+            style['value'] = str(category['@value'])
+            style['label'] = str(category['@label'])
+            style['symbol'] = name
+            style['render'] = str(category['@render'])
+            style['attribute'] = attribute
+            symbol_props(style, symbol)
+            styler.append(style)
+    return styler
+
+## Graduated style parser
+def graduated(renderer):
+    styler = []
+    symbols = symbol_index(renderer)
+    attribute = str(renderer['@attr'])
+    for datarange in as_list(renderer['ranges']['range']):
+        name = str(datarange['@symbol'])
+        for symbol in symbols.get(name, ()):
+            style = {}
+            style['pair'] = name + ',' + name
+            style['upper'] = str(datarange['@upper'])
+            style['lower'] = str(datarange['@lower'])
+            style['label'] = str(datarange['@label'])
+            style['render'] = str(datarange['@render'])
+            style['attribute'] = attribute
+            symbol_props(style, symbol)
+            styler.append(style)
+    return styler
+
+## Single symbol parser
+def singlesymbol(renderer):
+    styler = []
+    style = {}
+    symbol = as_list(renderer['symbols']['symbol'])[0]
+    style['alpha'] = symbol['@alpha']
+    for prop in as_list(symbol['layer']['prop']):
+        style[str(prop['@k'])] = str(prop['@v'])
+    styler.append(style)
+    return styler
+
+STYLE_PARSERS = {
+    'Singlesymbol': singlesymbol,
+    'Graduatedsymbol': graduated,
+    'Categorizedsymbol': categorized,
+}
+
+## Edit type field names, used for the presentations
+def fields(parsed):
+    if not parsed.get('edittypes'):
+        return []
+    return [field['@name'] for field in as_list(parsed['edittypes']['edittype'])]
+
+##################################################
+## QML READER                                   ##
+##################################################
+
+class StopReading(Exception):
+    pass
+
+class StyleReader(object):
+    """Reads the renderer-v2 and edittypes elements of a qml document from
+    expat events. Only the renderer attributes, its categories or ranges,
+    the props of the first layer of every symbol and the edit type names
+    are kept, everything else is dropped as it streams past. Reading stops
+    as soon as both elements have been read.
+    """
+
+    def __init__(self):
+        self.path = []
+        self.root = {}
+        self.parsed = {}
+        self.renderer = None
+        self.symbol = None
+        self.layer = None
+        self.done = set()
+
+    def read(self, qml):
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = self.start
+        parser.EndElementHandler = self.end
+        try:
+            if hasattr(qml, 'read'):
+                parser.ParseFile(qml)
+            else:
+                if isinstance(qml, unicode):
+                    qml = qml.encode('utf8')
+                parser.Parse(qml, True)
+        except StopReading:
+            pass
+        return self.parsed
+
+    def start(self, name, attrs):
+        path = self.path
+        path.append(name)
+        depth = len(path)
+        if depth == 1:
+            if name != 'qgis':
+                raise KeyError('qgis')
+            self.root = self.attributes(attrs)
+        elif depth == 2:
+            if name == 'renderer-v2':
+                self.renderer = self.attributes(attrs)
+                self.parsed['renderer-v2'] = self.renderer
+            elif name == 'edittypes':
+                self.parsed['edittypes'] = {'edittype': []}
+        elif path[1] == 'renderer-v2' and self.renderer is not None:
+            if depth == 3:
+                if name == 'categories':
+                    self.renderer['categories'] = {'category': []}
+                elif name == 'ranges':
+                    self.renderer['ranges'] = {'range': []}
+                elif name == 'symbols':
+                    self.renderer['symbols'] = {'symbol': []}
+            elif depth == 4:
+                if name == 'category' and path[2] == 'categories':
+                    self.renderer['categories']['category'].append(self.attributes(attrs))
+                elif name == 'range' and path[2] == 'ranges':
+                    self.renderer['ranges']['range'].append(self.attributes(attrs))
+                elif name == 'symbol' and path[2] == 'symbols':
+                    self.symbol = self.attributes(attrs)
+                    self.renderer['symbols']['symbol'].append(self.symbol)
+            elif depth == 5 and name == 'layer' and self.symbol is not None:
+                if 'layer' not in self.symbol:
+                    self.symbol['layer'] = {'prop': []}
+                    self.layer = self.symbol['layer']
+            elif depth == 6 and name == 'prop' and self.layer is not None and path[4] == 'layer':
+                self.layer['prop'].append(self.attributes(attrs))
+        elif depth == 3 and path[1] == 'edittypes' and name == 'edittype':
+            self.parsed['edittypes']['edittype'].append(self.attributes(attrs))
+
+    def end(self, name):
+        path = self.path
+        depth = len(path)
+        path.pop()
+        if depth == 5:
+            self.layer = None
+        elif depth == 4:
+            self.symbol = None
+        elif depth == 2:
+            self.done.add(name)
+            if 'renderer-v2' in self.done and 'edittypes' in self.done:
+                raise StopReading()
+
+    def attributes(self, attrs):
+        return dict(('@' + key, value) for key, value in attrs.items())
+
+## Scale band of a layer with scale based visibility, from the attributes
+## of the qgis element. Returns the (minimum, maximum) scale denominators,
+## 0 is no limit, or None when the layer is drawn at every scale.
+def scale_band(root):
+    if root.get('@hasScaleBasedVisibilityFlag') != '1':
+        return None
+    try:
+        minimum = float(root.get('@minimumScale', 0))
+        maximum = float(root.get('@maximumScale', 0))
+    except ValueError:
+        return None
+    if minimum < 0:
+        minimum = 0
+    if maximum < 0 or (maximum and maximum <= minimum):
+        maximum = 0
+    if not minimum and not maximum:
+        return None
+    return minimum, maximum
+
+## Layer style parser
+def layer_style(qml):
+    """Read a qml document once into the renderer type, the renderer
+    classes with their symbol props, the edit type fields and the scale
+    band of the layer. qml is a string or a file object.
+    """
+    reader = StyleReader()
+    parsed = reader.read(qml)
+    renderer = parsed['renderer-v2']
+    style = {}
+    style['renderer'] = str(renderer['@type']).capitalize()
+    style['classes'] = STYLE_PARSERS[style['renderer']](renderer)
+    style['fields'] = fields(parsed)
+    style['scale'] = scale_band(reader.root)
+    return style
+
+##################################################
+## LAYER SOURCE                                 ##
+##################################################
+
+## A quoted value ends at its closing quote, a backslash escapes the next
+## character and a doubled quote stands for the quote itself
+def quoted_value(layer_source, i):
+    quote = layer_source[i]
+    value = []
+    i += 1
+    while i < len(layer_source):
+        char = layer_source[i]
+        if char == '\\' and i + 1 < len(layer_source):
+            value.append(layer_source[i + 1])
+            i += 2
+        elif char == quote and layer_source[i + 1:i + 2] == quote:
+            value.append(quote)
+            i += 2
+        elif char == quote:
+            return ''.join(value), i + 1
+        else:
+            value.append(char)
+            i += 1
+    return ''.join(value), i
+
+def uri_value(layer_source, i):
+    if layer_source[i:i + 1] in ('"', "'"):
+        return quoted_value(layer_source, i)
+    end = layer_source.find(' ', i)
+    if end < 0:
+        end = len(layer_source)
+    return layer_source[i:end], end
+
+def uri_values(layer_source):
+    """The key=value pairs of a QGIS datasource uri. A quoted value may
+    hold spaces, table is joined from its quoted schema and table name and
+    the geometry column in parentheses after it is given as geom. The
+    subset filter, sql, runs to the end of the uri.
+    """
+    values = {}
+    i = 0
+    while i < len(layer_source):
+        if layer_source[i] == ' ':
+            i += 1
+        elif layer_source[i] == '(':
+            end = layer_source.find(')', i)
+            if end < 0:
+                end = len(layer_source)
+            column = layer_source[i + 1:end].strip()
+            if column[:1] in ('"', "'"):
+                column = quoted_value(column, 0)[0]
+            values['geom'] = column
+            i = end + 1
+        else:
+            end = layer_source.find(' ', i)
+            equals = layer_source.find('=', i)
+            if equals < 0 or (0 <= end < equals):
+                # a token without a value
+                i = len(layer_source) if end < 0 else end
+                continue
+            key = layer_source[i:equals]
+            if key == 'sql':
+                values['sql'] = layer_source[equals + 1:].strip()
+                break
+            value, i = uri_value(layer_source, equals + 1)
+            if key == 'table':
+                parts = [value]
+                while layer_source[i:i + 1] == '.':
+                    value, i = uri_value(layer_source, i + 1)
+                    parts.append(value)
+                value = '.'.join(parts)
+            values[key] = value
+    return values
+
+## Postgis layer source parser
+def source(layer_source):
+    """Split a postgres layer source into the connection dict used by the
+    builders, with the subset filter of the layer as sql when it has one.
+    Raises KeyError if the source is not a complete postgis source.
+    """
+    values = uri_values(layer_source)
+    conn = {}
+    for key in ('dbname', 'host', 'port', 'user', 'password', 'key', 'srid', 'type', 'table', 'geom'):
+        conn[key] = values[key]
+    if values.get('sql'):
+        conn['sql'] = values['sql']
+    return conn
+
+class SourceCache(object):
+    """Parsed layer sources by layer id. A source is only parsed again when
+    the source string of its layer changed, sources that are not complete
+    postgis sources are remembered as such.
+    """
+
+    def __init__(self):
+        self.sources = {}
+
+    def source(self, layer_id, layer_source):
+        """A copy of the connection dict of a layer, raises KeyError like
+        source for a layer that is not a postgis layer.
+        """
+        cached = self.sources.get(layer_id)
+        if cached is None or cached[0] != layer_source:
+            try:
+                conn = source(layer_source)
+            except KeyError:
+                conn = None
+            cached = self.sources[layer_id] = (layer_source, conn)
+        if cached[1] is None:
+            raise KeyError(layer_id)
+        return dict(cached[1])
+
+def transform_name(name):
+    formatted_name = name.encode('utf8').lower().replace(' ', '_').replace('å', 'aa').replace('ø', 'oe').replace('æ', 'ae')
+    return formatted_name
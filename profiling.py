@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import gc
+import os
+import sys
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not on Windows, the snapshots go without the peak memory use
+    resource = None
+
+# Environment variable that profiles every build, also from the plugin
+PROFILE_VARIABLE = 'QGIS2SPS_PROFILE'
+
+# Object types listed in a memory snapshot
+SNAPSHOT_TYPES = 25
+
+##################################################
+## STAGE PROFILES                               ##
+##################################################
+## A profiled build runs every stage under cProfile and writes
+## <stage>.pstats next to a <stage>-memory.txt snapshot of the objects left
+## alive at the end of the stage. Python 2 has no tracemalloc, so the
+## snapshot counts the objects the garbage collector tracks (dicts, lists,
+## OrderedDicts and instances, not the strings they hold) by type with
+## their own size, along with the peak memory use of the process.
+
+def enabled(options):
+    return options.get('profile') == 'true' or bool(os.environ.get(PROFILE_VARIABLE))
+
+def peak_memory():
+    """Peak resident memory of the process in kB, None where unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on mac, kB elsewhere
+        peak //= 1024
+    return peak
+
+def snapshot():
+    """Count and total size in bytes of the tracked objects by type name,
+    largest first.
+    """
+    counts = {}
+    sizes = {}
+    for obj in gc.get_objects():
+        name = type(obj).__module__ + '.' + type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+        try:
+            sizes[name] = sizes.get(name, 0) + sys.getsizeof(obj)
+        except TypeError:
+            pass
+    return sorted(((sizes.get(name, 0), counts[name], name) for name in counts), reverse=True)
+
+def snapshot_lines(stage, objects):
+    peak = peak_memory()
+    lines = ['Stage: ' + stage,
+             'Peak memory: ' + ('%d kB' % peak if peak is not None else 'unknown'),
+             'Tracked objects: %d, %d kB' % (sum(count for size, count, name in objects),
+                                             sum(size for size, count, name in objects) // 1024),
+             '',
+             '%10s %10s  %s' % ('kB', 'objects', 'type')]
+    for size, count, name in objects[:SNAPSHOT_TYPES]:
+        lines.append('%10d %10d  %s' % (size // 1024, count, name))
+    return lines
+
+class Profiler(object):
+    """Writes a profile and a memory snapshot of each stage to folder."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    @contextmanager
+    def stage(self, name):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(os.path.join(self.folder, name + '.pstats'))
+            with open(os.path.join(self.folder, name + '-memory.txt'), 'w') as f:
+                f.write('\n'.join(snapshot_lines(name, snapshot())) + '\n')
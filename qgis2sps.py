@@ -21,25 +21,44 @@
  ***************************************************************************/
 """
 import os.path
-from PyQt4.QtCore import QSettings, QTranslator, qVersion, QCoreApplication, QUrl
-from PyQt4.QtGui import QAction, QIcon, QFileDialog
-from PyQt4.QtWebKit import QWebView
+from PyQt4.QtCore import Qt, QSettings, QTimer, QTranslator, qVersion, QCoreApplication, QUrl, QVariant
+from PyQt4.QtGui import QAction, QIcon, QFileDialog, QListWidgetItem
 # Initialize Qt resources from file resources.py
 import resources_rc
-# Import the code for the dialog
-from qgis2sps_dialog import qgis2spsDialog
 
-from qgis.core import QgsMessageLog
+from qgis.core import QgsMessageLog, QgsFeatureRequest, NULL
 from qgis.utils import *
 
-from yattag import Doc
-from yattag import indent
-import xmltodict
-import time
-import parsers
-import builders
+# The dialog and the exporter modules are imported on the first run, QGIS
+# loads this module at startup for every user whether the plugin is used
+# or not
+import spec
 
+# Layers classified per step of the layer scan, between steps QGIS and the
+# dialog handle their events
+SCAN_BATCH = 100
 
+# Milliseconds between the batches of export messages shown in the dialog
+EXPORT_POLL = 250
+
+# Most processes building themes by default, inside QGIS the pool competes
+# with QGIS itself. The qgis2sps/processes setting overrides it.
+MAX_PROCESSES = 4
+
+def default_processes(cpus):
+    return max(1, min(MAX_PROCESSES, cpus - 1))
+
+# Provider field types a classitem compares as numbers
+NUMERIC_TYPES = (QVariant.Int, QVariant.UInt, QVariant.LongLong, QVariant.ULongLong, QVariant.Double)
+
+# Progress bar text of every stage of a build
+STAGE_LABELS = {
+    'datasources': 'Datakilder',
+    'themes': 'Temaer %v/%m',
+    'targets': 'Targetset',
+    'includes': 'Includes',
+    'read.me': 'read.me',
+}
 
 
 class qgis2sps:
@@ -70,7 +89,18 @@ class qgis2sps:
 
 			if qVersion() > '4.3.3':
 				QCoreApplication.installTranslator(self.translator)
-        self.dlg = qgis2spsDialog()
+        # Created by the first run
+        self.dlg = None
+        # Parsed layer sources, kept while QGIS runs
+        self.sources = None
+        # The layers of the project are scanned in batches by a timer
+        self.pending = []
+        self.scan_timer = QTimer()
+        self.scan_timer.timeout.connect(self.scan_batch)
+        # The running export and the timer fetching its messages
+        self.export = None
+        self.export_timer = QTimer()
+        self.export_timer.timeout.connect(self.poll_export)
 
 		# Declare instance attributes
         self.actions = []
@@ -110,12 +140,6 @@ class qgis2sps:
         whats_this=None,
         parent=None):
 
-        # Create the dialog (after translation) and keep reference
-        self.dlg = qgis2spsDialog()
-        self.dlg.lineEdit.clear()
-        self.dlg.pushButton.clicked.connect(self.select_output_file)
-        self.dlg.pushButton_2.clicked.connect(self.build_module)
-        self.dlg.pushButton_3.clicked.connect(self.close_clean)
         icon = QIcon(icon_path)
         action = QAction(icon, text, parent)
         action.triggered.connect(callback)
@@ -145,6 +169,12 @@ class qgis2sps:
 
     def unload(self):
         """Removes the plugin menu item and icon from QGIS GUI."""
+        self.stop_scan()
+        self.export_timer.stop()
+        if self.export is not None:
+            self.export.cancel()
+            self.export.wait()
+            self.export = None
         for action in self.actions:
             self.iface.removePluginWebMenu(
                 self.tr(u'&Spatial Suite'),
@@ -154,47 +184,26 @@ class qgis2sps:
         #del self.toolbar
 
 
-    def qgisPrepareData(self, connections, layers):
-        outputs = []
+    def create_dialog(self):
+        """Create the dialog (after translation) and keep reference, done
+        on the first run.
+        """
+        from qgis2sps_dialog import qgis2spsDialog
+        import parsers
+        self.dlg = qgis2spsDialog()
+        self.dlg.lineEdit.clear()
+        self.dlg.pushButton.clicked.connect(self.select_output_file)
+        self.dlg.pushButton_2.clicked.connect(self.build_module)
+        self.dlg.pushButton_3.clicked.connect(self.close_clean)
+        self.sources = parsers.SourceCache()
+
+    def qgisPrepareData(self):
+        import multiprocessing
+        from PyQt4.QtXml import QDomDocument
+        import frequency
         path = self.dlg.lineEdit.text()
         module_name = self.dlg.lineEdit_2.text()
-
-        try:
-            os.mkdir(path + '/' + module_name)
-        except:
-            pass
-        try:
-            os.mkdir(path + '/' + module_name + '/datasources')
-        except:
-            pass
-        try:
-            os.mkdir(path + '/' + module_name + '/themes')
-        except:
-            pass
-        try:
-            os.mkdir(path + '/' + module_name + '/presentations')
-        except:
-            pass
-        try:
-            os.mkdir(path + '/' + module_name + '/profiles')
-        except:
-            pass
-        try:
-            os.mkdir(path + '/' + module_name + '/profiles/includes')
-        except:
-            pass
-        try:
-            os.mkdir(path + '/' + module_name + '/queries')
-        except:
-            pass
-        try:
-            os.mkdir(path + '/' + module_name + '/qml')
-        except:
-            pass
-        try:
-            os.mkdir(path + '/' + module_name + '/temp')
-        except:
-            pass
+        module_path = path.replace('\\', '/') + '/' + module_name
 
         #Options
         options = {}
@@ -210,40 +219,96 @@ class qgis2sps:
             options['targets'] = 'true'
         else:
             options['targets'] = 'false'
+        if self.dlg.update.isChecked():
+            options['update'] = 'true'
+        else:
+            options['update'] = 'false'
+        if self.dlg.qml.isChecked():
+            options['qml'] = 'true'
+        else:
+            options['qml'] = 'false'
+        if self.dlg.compact.isChecked():
+            options['compact'] = 'true'
+        else:
+            options['compact'] = 'false'
+        if self.dlg.classitem.isChecked():
+            options['classitem'] = 'true'
+        else:
+            options['classitem'] = 'false'
+        if self.dlg.frequencies.isChecked():
+            options['frequencies'] = 'true'
+        else:
+            options['frequencies'] = 'false'
+        options['processes'] = QSettings().value('qgis2sps/processes', default_processes(multiprocessing.cpu_count()),
+                                                 type=int)
+        # Scale bands of simplified geometry, e.g. 25000:5,100000:25
+        options['generalize'] = QSettings().value('qgis2sps/generalize', '', type=str)
+        # Connection pool settings of the endpoints, e.g. maxconnections=10
+        options['pool'] = QSettings().value('qgis2sps/pool', '', type=str)
+        # Timing spans of the build, written to the temp folder of the module
+        options['trace'] = 'true' if QSettings().value('qgis2sps/trace', False, type=bool) else 'false'
+        # cProfile and memory snapshots of every stage, also with the QGIS2SPS_PROFILE environment variable
+        options['profile'] = 'true' if QSettings().value('qgis2sps/profile', False, type=bool) else 'false'
 
         #Selected layers
-        items = self.dlg.listWidget.selectedItems()
-        x = []
-        for i in list(items):
-            x.append(str(i.text()))
-        names = []
-        qmlfiles = []
-        for i in range (0,len(x)):
-            name = x[i].split(' - ')[0]
-            names.append(name)
-            for layer in layers:
-                layername = self.encode_and_transform_names(layer.name())
-                if layername == name:
-                    pathtoqml = path.replace('\\', '/') + '/' + module_name + '/qml/' + self.encode_and_transform_names(layer.name()) + '.qml'
-                    layer.saveNamedStyle(pathtoqml)
-                    qmlfiles.append(pathtoqml)
-        outputs.append(module_name)
-        outputs.append(path.replace('\\', '/') + '/' + module_name)
-        outputs.append(names)
-        outputs.append(qmlfiles)
-        outputs.append(options)
-        outputs.append(x)
-        outputs.append(connections)
-        return outputs
+        module = spec.ModuleSpec(module_name, module_path, options)
+        for item in self.dlg.listWidget.selectedItems():
+            layer_spec = self.catalog[item.data(Qt.UserRole)]
+            # The style is handed to the parsers in memory
+            doc = QDomDocument()
+            self.map_layers[layer_spec.id].exportNamedStyle(doc)
+            layer_spec.qml = doc.toString()
+            edittypes = doc.elementsByTagName('edittype')
+            layer_spec.fields = [edittypes.item(i).toElement().attribute('name') for i in range(edittypes.count())]
+            layer_spec.frequencies = None
+            if layer_spec.renderer in frequency.REORDERS:
+                layer_spec.attribute = self.map_layers[layer_spec.id].rendererV2().classAttribute()
+                layer_spec.numeric = self.numeric_field(self.map_layers[layer_spec.id], layer_spec.attribute)
+            if options['frequencies'] == 'true' and layer_spec.renderer in frequency.REORDERS:
+                layer_spec.frequencies = self.value_counts(self.map_layers[layer_spec.id], layer_spec.attribute)
+            module.add(layer_spec)
+        return module
         
+    def numeric_field(self, map_layer, attribute):
+        """True if attribute is a numeric field of the layer provider, None
+        if it is an expression and not a field.
+        """
+        index = map_layer.fieldNameIndex(attribute)
+        if index < 0:
+            return None
+        return map_layer.fields()[index].type() in NUMERIC_TYPES
+
+    def value_counts(self, map_layer, attribute):
+        """Counts of the values of attribute read through the layer
+        provider, None if the attribute is an expression and not a field.
+        """
+        from collections import Counter
+        import frequency
+        index = map_layer.fieldNameIndex(attribute)
+        if index < 0:
+            return None
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes([index])
+        counts = Counter()
+        for feature in map_layer.getFeatures(request):
+            value = feature[index]
+            if value is not None and value != NULL:
+                counts[frequency.value_key(value)] += 1
+        return dict(counts)
+
 ##################################################
 ## MAIN BUILDER BLOCK                           ##
 ##################################################
         
     def build_module(self):
+        if self.export is not None:
+            # the build button cancels a running export
+            self.export.cancel()
+            self.write_to_status('Annullerer...')
+            return
         items = self.dlg.listWidget.selectedItems()
         path = self.dlg.lineEdit.text()
         module_name = self.dlg.lineEdit_2.text()
+        invalid = self.invalid_setting()
         if len(items) == 0:
             self.writeerror('Udpeg lag')
         else:
@@ -254,237 +319,157 @@ class qgis2sps:
                     self.writeerror('Angiv modulnavn')
 
                 else:
-                    if os.path.isdir(path + '/' + module_name):
+                    if os.path.isdir(path + '/' + module_name) and not self.dlg.update.isChecked():
                         self.writeerror('Mappen findes allerede')
+                    elif invalid is not None:
+                        self.writeerror('Ugyldig indstilling: ' + invalid)
                     else:
-                        inputs = self.qgisPrepareData(connections, layers)
-
-        builders.epds(inputs)
-        global errors
-        errors = 0
-        # Themes
-        for i in range(0, len(inputs[5])):
-            layertype = inputs[5][i].split(' - ')[2]
-            render = inputs[5][i].split(' - ')[1]
-            qml_file = inputs[3][i]
-            if layertype in ('MultiPolygonZ', 'MultiPolygon', 'Polygon', 'PolygonZ'):
-                if render == 'Singlesymbol':
-                    try:
-                        styled = self.singlesymbol(qml_file)
-                        builders.singlesymbol(styled, inputs[0], inputs[1] , inputs[2][i], 'POLYGON')
-                        self.theme_done(str(inputs[2][i]))
-
-                    except:
-                        self.theme_error(str(inputs[2][i]))
-                if render == 'Graduatedsymbol':
-                    try:
-                        styled = self.graduated(qml_file)
-                        builders.graduated(styled, inputs[0], inputs[1] , inputs[2][i], 'POLYGON')
-                        self.theme_done(str(inputs[2][i]))
-                    except:
-                        self.theme_error(str(inputs[2][i]))
-                if render == 'Categorizedsymbol':
-                    try:
-                        styled = self.categorized(qml_file)
-                        builders.categorized(styled, inputs[0], inputs[1] , inputs[2][i], 'POLYGON')
-                        self.theme_done(str(inputs[2][i]))
-                    except:
-                        self.theme_error(str(inputs[2][i]))
-            if layertype in ('MultiLineStringZ', 'MultiLineString', 'LineString', 'LineStringZ'):
-                if render == 'Singlesymbol':
-                    try:
-                        styled = self.singlesymbol(qml_file)
-                        builders.singlesymbol(styled, inputs[0], inputs[1] , inputs[2][i], 'LINE')
-                        self.theme_done(str(inputs[2][i]))
-                    except:
-                        self.theme_error(str(inputs[2][i]))
-                if render == 'Graduatedsymbol':
-                    try:
-                        styled = self.graduated(qml_file)
-                        builders.graduated(styled, inputs[0], inputs[1] , inputs[2][i], 'LINE')
-                        self.theme_done(str(inputs[2][i]))
-                    except:
-                        self.theme_error(str(inputs[2][i]))
-                if render == 'Categorizedsymbol':
-                    try:
-                        styled = self.categorized(qml_file)
-                        builders.categorized(styled, inputs[0], inputs[1] , inputs[2][i], 'LINE')
-                        self.theme_done(str(inputs[2][i]))
-                    except:
-                        self.theme_error(str(inputs[2][i]))
-            if layertype in  ('MultiPointZ', 'MultiPoint', 'Point', 'PointZ'):
-                if render == 'Singlesymbol':
-                    try:
-                        styled = self.singlesymbol(qml_file)
-                        builders.singlesymbol(styled, inputs[0], inputs[1] , inputs[2][i], 'POINT')
-                        self.theme_done(str(inputs[2][i]))
-                    except:
-                        self.theme_error(str(inputs[2][i]))
-                if render == 'Graduatedsymbol':
-                    try:
-                        styled = self.graduated(qml_file)
-                        builders.graduated(styled, inputs[0], inputs[1] , inputs[2][i], 'POINT')
-                        self.theme_done(str(inputs[2][i]))
-                    except:
-                        self.theme_error(str(inputs[2][i]))
-                if render == 'Categorizedsymbol':
-                    try:
-                        styled = self.categorized(qml_file)
-                        builders.categorized(styled, inputs[0], inputs[1] , inputs[2][i], 'POINT')
-                        sself.theme_done(str(inputs[2][i]))
-                    except:
-                        self.theme_error(str(inputs[2][i]))
-        if self.dlg.presentations.isChecked():
-            builders.pres(inputs)
-        if self.dlg.targets.isChecked():
-            builders.target(inputs)
-        if self.dlg.includes.isChecked():
-            builders.themegroups(inputs)
-            builders.themes(inputs)
-        builders.readme(inputs)
+                        self.start_export(self.qgisPrepareData())
+
+    def start_export(self, module):
+        """Build the module in a background thread, the dialog polls it
+        for messages and progress.
+        """
+        from export_task import ExportTask
+        self.export = ExportTask(module)
+        self.dlg.pushButton_2.setText('Annuller')
+        self.dlg.progressBar.setValue(0)
+        self.export.start()
+        self.export_timer.start(EXPORT_POLL)
+
+    def poll_export(self):
+        export = self.export
+        if export is None:
+            self.export_timer.stop()
+            return
+        finished = export.isFinished()
+        lines = []
+        failed = False
+        for themename, error in export.fetch():
+            if error is None:
+                lines.append('Tema ' + str(themename) + ' dannet')
+            else:
+                lines.append('Fejl i tema ' + str(themename))
+                failed = True
+                if error:
+                    QgsMessageLog.logMessage(error, 'qgis2sps', QgsMessageLog.CRITICAL)
+        if lines:
+            self.dlg.textEdit.append('\n'.join(lines))
+        if failed:
+            self.writeerror('Fejl i tema')
+        if export.progress is not None:
+            stage, done, total = export.progress
+            self.dlg.progressBar.setMaximum(total)
+            self.dlg.progressBar.setValue(done)
+            self.dlg.progressBar.setFormat(STAGE_LABELS.get(stage, stage))
+        if finished:
+            self.export_timer.stop()
+            self.export = None
+            self.dlg.pushButton_2.setText('Dan Modul')
+            self.export_done(export)
+
+    def export_done(self, export):
+        import exporter
+        import profiling
+        import tracing
+        if export.module.options.get('trace') == 'true':
+            path = exporter.trace_file(export.module.path, export.module.name)
+            if os.path.isfile(path):
+                QgsMessageLog.logMessage('Sporing skrevet til ' + path, 'qgis2sps', QgsMessageLog.INFO)
+                for line in tracing.summary(path):
+                    QgsMessageLog.logMessage(line, 'qgis2sps', QgsMessageLog.INFO)
+        if export.error is not None:
+            QgsMessageLog.logMessage(export.error, 'qgis2sps', QgsMessageLog.CRITICAL)
+            self.writeerror('Modul afbrudt af en fejl')
+            return
+        if export.stopped:
+            self.dlg.textEdit.append('Modul annulleret!')
+            self.writeerror('Modul annulleret')
+            return
+        if profiling.enabled(export.module.options):
+            QgsMessageLog.logMessage('Profiler skrevet til ' + export.module.path + '/' + exporter.PROFILE_FOLDER,
+                                     'qgis2sps', QgsMessageLog.INFO)
+        errors = [layer for layer, error in export.results if error is not None]
         self.dlg.textEdit.append('Modul afsluttet!')
-        if errors == 0:
+        if len(errors) == 0:
             self.writesuccess('Modul afsluttet uden fejl')
         else:
             self.writeerror('Modul afsluttet med fejl')
 
-##################################################
-## PARSERS                                      ##
-##################################################
-           
-## Catogorized style parser
-    def categorized(self, qml):
-        with open(qml) as f:
-            styler = [] 
-            parsed = xmltodict.parse(f)
-            categories = parsed['qgis']['renderer-v2']['categories']  
-            renderer = parsed['qgis']['renderer-v2']
-            symbols = parsed['qgis']['renderer-v2']['symbols'] 
-            category = categories['category']
-            for i in range(0, len(category)):
-                symbol = symbols['symbol']
-                for b in range (0, len(symbol)):
-                    if str(symbol[b]['@name']) ==  str(category[i]['@symbol']):
-                        style = {}
-                        style['pair'] = str(symbol[b]['@name'])+','+ str(category[i]['@symbol'])
-                        style['value'] = str(category[i]['@value'])
-                        style['label'] = str(category[i]['@label'])
-                        style['symbol'] = str(category[i]['@symbol'])
-                        style['render'] = str(category[i]['@render'])
-                        style['attribute'] = str(renderer['@attr'])
-                        style['alpha'] =  str(symbol[b]['@alpha'])
-                        props = symbol[b]['layer']['prop']
-                        for t in range (0, len(props)):
-                            style[str(props[t]['@k'])] = str(props[t]['@v'])
-                        styler.append(style)
-        return styler
-        
-## Graduated style parser
-    def graduated(self, qml):
-        with open(qml) as f:
-            styler = [] 
-            parsed = xmltodict.parse(f)
-            ranges = parsed['qgis']['renderer-v2']['ranges']
-            renderer = parsed['qgis']['renderer-v2']
-            symbols = parsed['qgis']['renderer-v2']['symbols'] 
-            datarange = ranges['range']
-            for i in datarange:
-                symbol = symbols['symbol']
-                for b in symbol:
-                    if str(b['@name']) ==  str(i['@symbol']):
-                        style = {}
-                        style['pair'] = str(b['@name'])+','+ str(i['@symbol'])
-                        style['upper'] = str(i['@upper'])
-                        style['lower'] = str(i['@lower'])
-                        style['label'] = str(i['@label'])
-                        style['render'] = str(i['@render'])
-                        style['attribute'] = str(renderer['@attr'])
-                        style['alpha'] =  str(b['@alpha'])             
-                        props = b['layer']['prop']
-                        for t in props:
-                            style[str(t['@k'])] = str(t['@v'])
-                        styler.append(style)
-        return styler
-        
-## Single symbol parser
-    def singlesymbol(self, qml):
-        with open(qml) as f:
-            styler = []
-            style = {}
-            parsed = xmltodict.parse(f)
-            renderer = dict(parsed['qgis']['renderer-v2']['symbols']['symbol'])
-            style['alpha'] =  renderer['@alpha']
-            layer = dict(parsed['qgis']['renderer-v2']['symbols']['symbol']['layer'])
-            for i in range(0, len(layer['prop'])):
-               style[str(layer['prop'][i]['@k'])] =  str(layer['prop'][i]['@v'])
-            styler.append(style)
-        return styler
+    def invalid_setting(self):
+        """The first plugin setting that can not be read, None when they all can."""
+        import builders
+        import generalize
+        for key, parse in (('qgis2sps/generalize', generalize.parse_bands),
+                           ('qgis2sps/pool', builders.pool_settings)):
+            try:
+                parse(QSettings().value(key, '', type=str))
+            except ValueError:
+                return key
+        return None
 
 ##################################################
 ## Prepare the GUI                              ##
 ##################################################
 
     def init_gui(self):
-        global layers
-        layers = self.iface.legendInterface().layers()
-        global connections
-        connections = []
-        self.close_clean()
+        if self.export is not None:
+            # the dialog was closed during an export, which keeps running
+            # and reporting to it
+            return
+        # Compatible layers by layer id, scanned once per dialog
+        self.catalog = {}
+        self.map_layers = {}
+        self.stop_scan()
+        self.clean()
         self.dlg.listWidget.clear()
         self.dlg.lineEdit_2.setText('')
         self.dlg.lineEdit.setText('')
         self.write_to_status('Plugin initialiseret!')
-        compatible_types = ['Singlesymbol', 'singleSymbol', 'Categorizedsymbol', 'categorizedSymbol', 'Graduatedsymbol',
-                            'graduatedSymbol']
-        compatibleLayers = 0
-        incompatibleLayers = 0
-        for layer in layers:
-            connection = layer.source()
-            conn = {}
-            elements = connection.replace("'", "").replace('"', '').split(' ')
-
-            elm_dict = {}
-
-            for i in range(len(elements)):
-                try:
-                    elm = elements[i].split('=')
-                    obj = elm[0]
-                    value = elm[1]
-                    elm_dict[obj] = value
-                except:
-                    elm = elements[i].replace('(', '').replace(')', '')
-
-                    elm_dict['geom'] = elm
+        self.compatibleLayers = 0
+        self.incompatibleLayers = 0
+        # The dialog opens at once and the list fills as the layers are scanned
+        self.pending = self.iface.legendInterface().layers()
+        self.pending.reverse()
+        self.scan_timer.start(0)
+
+        file_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "docs.html"))
+        local_url = QUrl.fromLocalFile(file_path)
+        self.dlg.webView.load(local_url)
 
+    def scan_batch(self):
+        """Classify the next batch of layers and list the compatible ones."""
+        import exporter
+        self.dlg.listWidget.setUpdatesEnabled(False)
+        for i in range(min(SCAN_BATCH, len(self.pending))):
+            layer = self.pending.pop()
             try:
+                conn = self.sources.source(layer.id(), layer.source())
+                name = self.encode_and_transform_names(layer.name())
                 conn['displayname'] = layer.name()
-                conn['layername'] = self.encode_and_transform_names(layer.name())
-                conn['dbname'] = elm_dict['dbname']
-                conn['host'] = elm_dict['host']
-                conn['port'] = elm_dict['port']
-                conn['user'] = elm_dict['user']
-                conn['password'] = elm_dict['password']
-                conn['key'] = elm_dict['key']
-                conn['srid'] = elm_dict['srid']
-                conn['type'] = elm_dict['type']
-                conn['table'] = elm_dict['table']
-                conn['geom'] = elm_dict['geom']
-                renderer = layer.rendererV2().type()
-                if renderer.capitalize() in compatible_types:
-                    name = self.encode_and_transform_names(layer.name())
-                    self.dlg.listWidget.addItem(name + ' - ' + renderer.capitalize() + ' - ' + conn['type'])
-                    connections.append(conn)
-                    compatibleLayers += 1
-                else:
-                    y = 0
+                conn['layername'] = name
+                renderer = layer.rendererV2().type().capitalize()
+                if renderer in exporter.COMPATIBLE_TYPES:
+                    layer_spec = spec.LayerSpec(layer.id(), name, layer.name(), renderer, conn)
+                    self.catalog[layer_spec.id] = layer_spec
+                    self.map_layers[layer_spec.id] = layer
+                    item = QListWidgetItem(layer_spec.label())
+                    item.setData(Qt.UserRole, layer_spec.id)
+                    self.dlg.listWidget.addItem(item)
+                    self.compatibleLayers += 1
             except:
-                incompatibleLayers += 1
-        self.write_to_status('Kompatible lag : ' + str(compatibleLayers))
-        self.write_to_status('Inkompatible lag : ' + str(incompatibleLayers))
+                self.incompatibleLayers += 1
+        self.dlg.listWidget.setUpdatesEnabled(True)
+        self.dlg.label.setText(u'Tilgængelige lag (%d kompatible, %d inkompatible)' % (
+            self.compatibleLayers, self.incompatibleLayers))
+        if not self.pending:
+            self.scan_timer.stop()
+            self.write_to_status('Kompatible lag : ' + str(self.compatibleLayers))
+            self.write_to_status('Inkompatible lag : ' + str(self.incompatibleLayers))
 
-        file_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "docs.html"))
-        local_url = QUrl.fromLocalFile(file_path)
-        self.dlg.webView.load(local_url)
+    def stop_scan(self):
+        self.scan_timer.stop()
+        self.pending = []
 
 
 ##################################################
@@ -500,28 +485,25 @@ class qgis2sps:
     def write_to_status(self, text):
         self.dlg.textEdit.append(text)
 
-    def theme_error(self, themename):
-        self.dlg.textEdit.append('Fejl i tema ' + str(themename))
-        self.writeerror('Fejl i tema ' + str(themename))
-        errors += 1
-
-    def theme_done(self, themename):
-        self.dlg.textEdit.append('Tema ' + str(themename) + ' dannet')
-
 ##################################################
 ## Misc                                         ##
 ##################################################
 
     def encode_and_transform_names(self, name):
-        formatted_name = name.encode('utf8').lower().replace(' ', '_').replace('å', 'aa').replace('ø', 'oe').replace('æ', 'ae')
-        return formatted_name
+        import parsers
+        return parsers.transform_name(name)
 
     def select_output_file(self):
         #filename = QFileDialog.getSaveFileName(self.dlg, "Select output file ","", '*.txt')
         folder = QFileDialog.getExistingDirectory(self.dlg, "Select Directory")
         self.dlg.lineEdit.setText(folder)
 
+    ## The Luk button cancels a running export, closing the dialog with X
+    ## or Esc leaves it running
     def close_clean(self):
+        self.stop_scan()
+        if self.export is not None:
+            self.export.cancel()
         self.dlg.accept()
         self.clean()
 
@@ -534,6 +516,8 @@ class qgis2sps:
 
     def run(self):
         """Run method that performs all the real work"""
+        if self.dlg is None:
+            self.create_dialog()
         self.init_gui()
         # show the dialog
         self.dlg.show()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ qgs_export
+                                 A QGIS plugin
+ Export qgis project to sps module
+                              -------------------
+        begin                : 2017-02-13
+        copyright            : (C) 2017 by Sweco
+        email                : mortenwinther.fuglsang@sweco.dk
+ ***************************************************************************/
+
+ Command line exporter that builds a Spatial Suite module straight from a
+ .qgs project file, without starting QGIS:
+
+     python qgs_export.py project.qgs /path/to/modules modulename
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import xmltodict
+import parsers
+import builders
+import exporter
+import frequency
+import generalize
+import profiling
+import spec
+import tracing
+
+# Elements of a <maplayer> that belong to the layer and not to its style
+LAYER_KEYS = ('id', 'datasource', 'keywordList', 'layername', 'srs', 'provider')
+
+# Attributes of a <maplayer> that QGIS puts on the <qgis> element of a style
+SCALE_ATTRIBUTES = ('hasScaleBasedVisibilityFlag', 'minimumScale', 'maximumScale')
+
+
+class ProjectReader(object):
+    """Streams the <maplayer> elements of a .qgs project one at a time into
+    a ModuleSpec, keeping the style of every compatible postgis layer as a
+    qml document.
+    """
+
+    def __init__(self, module, selected=None):
+        self.module = module
+        self.selected = selected
+        self.incompatible = 0
+
+    def read(self, qgs_file):
+        with open(qgs_file, 'rb') as f:
+            xmltodict.parse(f, item_depth=3, item_callback=self.maplayer)
+
+    def maplayer(self, path, item):
+        if path[-1][0] != 'maplayer' or path[-2][0] != 'projectlayers' or not item:
+            return True
+        try:
+            conn = parsers.source(item['datasource'])
+            renderer = item['renderer-v2']['@type'].capitalize()
+        except (KeyError, TypeError):
+            self.incompatible += 1
+            return True
+        if renderer not in exporter.COMPATIBLE_TYPES:
+            return True
+        name = parsers.transform_name(item['layername'])
+        if self.selected and name not in self.selected:
+            return True
+        conn['displayname'] = item['layername']
+        conn['layername'] = name
+        qml = self.qml(path[0][1], path[-1][1], item)
+        attribute = item['renderer-v2'].get('@attr')
+        self.module.add(spec.LayerSpec(item.get('id'), name, item['layername'], renderer, conn, qml, attribute,
+                                       parsers.fields(item)))
+        return True
+
+    def qml(self, project_attrs, layer_attrs, item):
+        style = OrderedDict()
+        if project_attrs and 'version' in project_attrs:
+            style['@version'] = project_attrs['version']
+        for key in SCALE_ATTRIBUTES:
+            if layer_attrs and key in layer_attrs:
+                style['@' + key] = layer_attrs[key]
+        for key, value in item.items():
+            if not key.startswith('@') and key not in LAYER_KEYS:
+                style[key] = value
+        return xmltodict.unparse(OrderedDict([('qgis', style)]), pretty=True)
+
+
+def export(qgs_file, path, module_name, selected=None, options=None):
+    """Export the compatible layers of qgs_file as module_name in path.
+    Returns the (layer_name, error) result of every theme.
+
+    The classes of categorized and graduated themes are ordered by the
+    value frequencies of the statistics option, a json file, or of the
+    layer databases with the frequencies option.
+    """
+    module_path = path.replace('\\', '/') + '/' + module_name
+    if options is None:
+        options = {'include': 'true', 'presentations': 'true', 'targets': 'true', 'processes': 1}
+    if os.path.isdir(module_path) and options.get('update') != 'true':
+        raise IOError('Mappen findes allerede: ' + module_path)
+    module = spec.ModuleSpec(module_name, module_path, options)
+    ProjectReader(module, selected).read(qgs_file)
+    if options.get('statistics'):
+        counts = frequency.load(options['statistics'])
+        for layer in module.layers:
+            layer.frequencies = counts.get(layer.name)
+    elif options.get('frequencies') == 'true':
+        frequency.query(module)
+    return exporter.build(module, theme_done, theme_error)
+
+def theme_done(themename):
+    print('Tema ' + themename + ' dannet')
+
+def theme_error(themename, error=None):
+    sys.stderr.write('Fejl i tema ' + themename + '\n')
+    if error is not None:
+        sys.stderr.write(error)
+
+
+def generalize_option(text):
+    try:
+        generalize.parse_bands(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError('forventer skala[:tolerance],...: ' + text)
+    return text
+
+
+def pool_option(text):
+    try:
+        builders.pool_settings(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError('forventer navn=værdi,...: ' + text)
+    return text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export a qgis project to a Spatial Suite module')
+    parser.add_argument('project', help='.qgs project file')
+    parser.add_argument('folder', help='folder the module is created in')
+    parser.add_argument('module', help='module name')
+    parser.add_argument('-l', '--layer', action='append', dest='layers',
+                        help='only export this layer (transformed name), may be repeated')
+    parser.add_argument('--no-presentations', action='store_true')
+    parser.add_argument('--no-targets', action='store_true')
+    parser.add_argument('--no-includes', action='store_true')
+    parser.add_argument('-u', '--update', action='store_true',
+                        help='update an existing module, only rebuilding layers that changed')
+    parser.add_argument('--qml', action='store_true', help='also write the layer styles to <module>/qml')
+    parser.add_argument('--compact', action='store_true',
+                        help='merge renderer classes that are drawn the same way')
+    parser.add_argument('--classitem', action='store_true',
+                        help='declare the attribute of categorized themes once as classitem')
+    parser.add_argument('--frequencies', action='store_true',
+                        help='order categorized and graduated classes by value frequency in the database (needs psycopg2)')
+    parser.add_argument('--statistics', metavar='FILE',
+                        help='order classes by the value counts in a json file: {"layer": {"value": count}}')
+    parser.add_argument('--generalize', metavar='BANDS', type=generalize_option,
+                        help='switch polygon and line themes to simplified views beyond these scales, '
+                             'e.g. 25000:5,100000:25 (scale:tolerance), and write the SQL creating them')
+    parser.add_argument('--pool', metavar='SETTINGS', type=pool_option,
+                        help='connection pool settings written in every endpoint, e.g. maxconnections=10')
+    parser.add_argument('--trace', action='store_true',
+                        help='write the timing spans of the build to <module>/' + exporter.TRACE_FILE +
+                             ' (chrome://tracing), or to the system temp folder when no module is '
+                             'written, and print the slowest')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile every stage of the build with cProfile and snapshot its memory use to '
+                             '<module>/' + exporter.PROFILE_FOLDER + ' (also with ' + profiling.PROFILE_VARIABLE + '=1)')
+    parser.add_argument('-j', '--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='number of processes building themes (default: one per cpu)')
+    args = parser.parse_args(argv)
+    options = {
+        'include': 'false' if args.no_includes else 'true',
+        'presentations': 'false' if args.no_presentations else 'true',
+        'targets': 'false' if args.no_targets else 'true',
+        'qml': 'true' if args.qml else 'false',
+        'update': 'true' if args.update else 'false',
+        'compact': 'true' if args.compact else 'false',
+        'classitem': 'true' if args.classitem else 'false',
+        'frequencies': 'true' if args.frequencies else 'false',
+        'statistics': args.statistics,
+        'generalize': args.generalize,
+        'pool': args.pool,
+        'processes': args.processes,
+        'trace': 'true' if args.trace else 'false',
+        'profile': 'true' if args.profile else 'false',
+    }
+    started = time.time()
+    try:
+        results = export(args.project, args.folder, args.module, args.layers, options)
+    finally:
+        if args.trace:
+            path = exporter.trace_file(args.folder.replace('\\', '/') + '/' + args.module, args.module)
+            # not the trace of an earlier export
+            if os.path.isfile(path) and os.path.getmtime(path) >= int(started):
+                print('Sporing skrevet til ' + path)
+                for line in tracing.summary(path):
+                    print(line)
+    if all(error is None for layer, error in results):
+        print('Modul afsluttet uden fejl')
+        return 0
+    print('Modul afsluttet med fejl')
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
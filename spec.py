@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+RENDER_TYPES = {
+    'POLYGON': ('MultiPolygonZ', 'MultiPolygon', 'Polygon', 'PolygonZ'),
+    'LINE': ('MultiLineStringZ', 'MultiLineString', 'LineString', 'LineStringZ'),
+    'POINT': ('MultiPointZ', 'MultiPoint', 'Point', 'PointZ'),
+}
+
+def render_type(layertype):
+    for geometry, layertypes in RENDER_TYPES.items():
+        if layertype in layertypes:
+            return geometry
+    return None
+
+
+class LayerSpec(object):
+    """A layer going into a module.
+
+    name is the transformed layer name used in file and datasource names,
+    renderer the capitalized QGIS renderer type, geometrytype the type from
+    the layer source, connection the parsed layer source and qml the layer
+    style as a qml document. attribute is the classification attribute of
+    categorized and graduated layers and frequencies the counts of its
+    values, when the classes are ordered by frequency. fields are the
+    field names of the layer style, the columns of its presentation.
+    numeric tells if attribute is a numeric field, None when the field type
+    is not known.
+    """
+    __slots__ = ('id', 'name', 'displayname', 'renderer', 'geometrytype', 'connection', 'qml',
+                 'attribute', 'frequencies', 'fields', 'numeric')
+
+    def __init__(self, id, name, displayname, renderer, connection, qml=None, attribute=None, fields=None,
+                 numeric=None):
+        self.id = id
+        self.name = name
+        self.displayname = displayname
+        self.renderer = renderer
+        self.geometrytype = connection['type']
+        self.connection = connection
+        self.qml = qml
+        self.attribute = attribute
+        self.frequencies = None
+        self.fields = fields
+        self.numeric = numeric
+
+    @property
+    def render_type(self):
+        return render_type(self.geometrytype)
+
+    def label(self):
+        """The text shown for the layer in the layer list."""
+        return self.name + ' - ' + self.renderer + ' - ' + self.geometrytype
+
+    # __slots__ classes need explicit state to be sent to pool workers
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+
+class ModuleSpec(object):
+    """A module and its layers, indexed by transformed name."""
+    __slots__ = ('name', 'path', 'options', 'layers', 'by_name')
+
+    def __init__(self, name, path, options):
+        self.name = name
+        self.path = path
+        self.options = options
+        self.layers = []
+        self.by_name = {}
+
+    def add(self, layer):
+        self.layers.append(layer)
+        self.by_name[layer.name] = layer
+        return layer
+
+    def names(self):
+        return [layer.name for layer in self.layers]
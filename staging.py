@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import Queue
+import os
+import shutil
+import tempfile
+import threading
+
+# Threads copying files to and from the module folder, the copies wait on
+# the disk or network share and not on the interpreter
+COPY_THREADS = 8
+
+# Suffix of a module folder, or of a file of it, while it is published
+NEW_SUFFIX = '.qgis2sps-new'
+
+##################################################
+## STAGED BUILD                                 ##
+##################################################
+## Modules often live on a network share, where the many small writes,
+## renames and deletes of a build are slow and a failed build leaves a
+## half written module. A module is therefore built in a local staging
+## folder, starting from a copy of the existing module. A new module is
+## published by copying it next to the module folder and renaming it into
+## place. An update only copies the files whose bytes changed next to the
+## files they replace, and renames them over those when all are copied.
+
+def copy_file(paths):
+    shutil.copy2(*paths)
+
+def copy_files(copies, threads=COPY_THREADS):
+    """Copy the (source, destination) pairs, in parallel when there are
+    more than one.
+    """
+    if len(copies) < 2 or threads < 2:
+        for paths in copies:
+            copy_file(paths)
+        return
+    pending = Queue.Queue()
+    for paths in copies:
+        pending.put(paths)
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                paths = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                copy_file(paths)
+            except Exception as error:
+                errors.append(error)
+    workers = [threading.Thread(target=worker) for i in range(min(threads, len(copies)))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def copy_tree(source, destination, threads=COPY_THREADS):
+    """Copy the folder source to destination, which must not exist, with
+    the files copied in parallel. Modification times are kept so an update
+    only changes the times of the files it rewrote.
+    """
+    copies = []
+    for root, dirs, names in os.walk(source):
+        folder = os.path.join(destination, os.path.relpath(root, source))
+        os.makedirs(folder)
+        copies.extend((os.path.join(root, name), os.path.join(folder, name)) for name in names)
+    copy_files(copies, threads)
+
+def tree(folder):
+    """The sub folders and the (size, modification time) of the files of
+    folder, by path relative to it.
+    """
+    folders = set()
+    files = {}
+    for root, dirs, names in os.walk(folder):
+        relative = os.path.relpath(root, folder)
+        if relative != os.curdir:
+            folders.add(relative)
+        for name in names:
+            path = os.path.join(root, name)
+            files[os.path.normpath(os.path.join(relative, name))] = (os.path.getsize(path), os.path.getmtime(path))
+    return folders, files
+
+def same_bytes(first, second):
+    if not os.path.isfile(second) or os.path.getsize(first) != os.path.getsize(second):
+        return False
+    with open(first, 'rb') as f:
+        with open(second, 'rb') as g:
+            return f.read() == g.read()
+
+def replace(source, destination):
+    try:
+        os.rename(source, destination)
+    except OSError:
+        # windows does not rename over an existing file
+        os.remove(destination)
+        os.rename(source, destination)
+
+def remove_tree(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+class Staging(object):
+    """A local copy of the module folder target, the module is built in
+    path and published to target when it is done. A new module is
+    published as a whole, an existing one only gets the files that
+    changed.
+    """
+
+    def __init__(self, target, threads=COPY_THREADS):
+        self.target = target
+        self.threads = threads
+        self.root = tempfile.mkdtemp(prefix='qgis2sps-')
+        self.path = self.root.replace('\\', '/') + '/' + os.path.basename(target)
+        # the staged copy of an existing module as it was before the build
+        self.snapshot = None
+        try:
+            if os.path.isdir(target):
+                copy_tree(target, self.path, threads)
+                self.snapshot = tree(self.path)
+            else:
+                os.mkdir(self.path)
+        except:
+            self.discard()
+            raise
+
+    def publish(self):
+        try:
+            if self.snapshot is None:
+                self.publish_module()
+            else:
+                self.publish_changes()
+        finally:
+            self.discard()
+
+    def publish_module(self):
+        """Copy the staged module next to the module folder and rename it
+        into place, so the module folder only appears when it is complete.
+        """
+        new = self.target + NEW_SUFFIX
+        # left behind by a publish that was interrupted
+        remove_tree(new)
+        try:
+            copy_tree(self.path, new, self.threads)
+            os.rename(new, self.target)
+        except:
+            remove_tree(new)
+            raise
+
+    def publish_changes(self):
+        """Copy the files the build wrote or changed to the module folder
+        and remove the ones it removed, the other files are not touched.
+        Nothing changes in the module folder before every changed file has
+        been copied next to the file it replaces.
+        """
+        folders, files = self.snapshot
+        staged_folders, staged_files = tree(self.path)
+        changed = []
+        for name, stat in staged_files.items():
+            if files.get(name) == stat:
+                continue
+            if not same_bytes(os.path.join(self.path, name), os.path.join(self.target, name)):
+                changed.append(name)
+        created = []
+        try:
+            for folder in sorted(staged_folders - folders):
+                if not os.path.isdir(os.path.join(self.target, folder)):
+                    os.mkdir(os.path.join(self.target, folder))
+                    created.append(folder)
+            copy_files([(os.path.join(self.path, name), os.path.join(self.target, name) + NEW_SUFFIX)
+                        for name in changed], self.threads)
+        except:
+            for name in changed:
+                if os.path.isfile(os.path.join(self.target, name) + NEW_SUFFIX):
+                    os.remove(os.path.join(self.target, name) + NEW_SUFFIX)
+            for folder in reversed(created):
+                remove_tree(os.path.join(self.target, folder))
+            raise
+        for name in changed:
+            replace(os.path.join(self.target, name) + NEW_SUFFIX, os.path.join(self.target, name))
+        for name in files:
+            if name not in staged_files and os.path.isfile(os.path.join(self.target, name)):
+                os.remove(os.path.join(self.target, name))
+        for folder in sorted(folders - staged_folders, reverse=True):
+            remove_tree(os.path.join(self.target, folder))
+
+    def discard(self):
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -170,6 +170,28 @@ class QgisInterface(QObject):
         """
         pass
 
+    def addPluginToWebMenu(self, name, action):
+        """Add an action to a submenu of the Web menu.
+
+        :param name: Name of the submenu.
+        :type name: str
+
+        :param action: Action to add to the menu.
+        :type action: QAction
+        """
+        pass
+
+    def removePluginWebMenu(self, name, action):
+        """Remove an action from a submenu of the Web menu.
+
+        :param name: Name of the submenu.
+        :type name: str
+
+        :param action: Action to remove from the menu.
+        :type action: QAction
+        """
+        pass
+
     def addToolBar(self, name):
         """Add toolbar with specified name.
 
@@ -0,0 +1,100 @@
+# coding=utf-8
+"""Class compaction test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'mortenwinther.fuglsang@sweco.dk'
+__date__ = '2017-02-13'
+__copyright__ = 'Copyright 2017, Sweco'
+
+import shutil
+import tempfile
+import unittest
+
+import builders
+import compaction
+import exporter
+import spec
+
+RED = '255,0,0,255'
+BLUE = '0,0,255,255'
+
+
+def polygon(color, **values):
+    style = {'alpha': '1', 'color': color, 'outline_color': '0,0,0,0', 'outline_width': '0.26',
+             'outline_width_unit': 'MM', 'render': 'true', 'attribute': 'felt'}
+    style.update(values)
+    return style
+
+
+class CompactionTest(unittest.TestCase):
+    """Test classes drawn the same way are merged."""
+
+    def test_categories(self):
+        """Test categories with the same style become one class."""
+        classes = [polygon(RED, value='a'), polygon(BLUE, value='b'), polygon(RED, value='c')]
+        compacted = compaction.compact('Categorizedsymbol', classes, 'POLYGON')
+        self.assertEqual([style['values'] for style in compacted], [['a', 'c'], ['b']])
+        self.assertEqual(classes[0].get('values'), None)
+
+    def test_categories_kept_apart(self):
+        """Test values that can not go in an in list are not merged."""
+        classes = [polygon(RED, value='a,b'), polygon(RED, value=''), polygon(RED, value='c'),
+                   polygon(RED, value='d', render='false')]
+        compacted = compaction.compact('Categorizedsymbol', classes, 'POLYGON')
+        self.assertEqual(len(compacted), 4)
+
+    def test_ranges(self):
+        """Test only adjacent ranges with the same style are merged."""
+        classes = [polygon(RED, lower='0.000000', upper='10.000000', label='0 - 10'),
+                   polygon(RED, lower='10.000000', upper='20.500000', label='10 - 20.5'),
+                   polygon(BLUE, lower='20.500000', upper='30.000000', label='20.5 - 30'),
+                   polygon(RED, lower='30.000000', upper='40.000000', label='30 - 40'),
+                   polygon(RED, lower='50.000000', upper='60.000000', label='50 - 60')]
+        compacted = compaction.compact('Graduatedsymbol', classes, 'POLYGON')
+        self.assertEqual([(style['lower'], style['upper'], style['label']) for style in compacted], [
+            ('0.000000', '20.500000', '0 - 20.5'),
+            ('20.500000', '30.000000', '20.5 - 30'),
+            ('30.000000', '40.000000', '30 - 40'),
+            ('50.000000', '60.000000', '50 - 60')])
+
+    def test_theme(self):
+        """Test merged categories are written with an in expression."""
+        folder = tempfile.mkdtemp()
+        try:
+            exporter.make_folders(folder)
+            layer = spec.LayerSpec('id', 'lag', 'Lag', 'Categorizedsymbol', {'type': 'MultiPolygon'})
+            classes = [polygon(RED, value='a'), polygon(RED, value='c')]
+            builders.categorized(compaction.compact('Categorizedsymbol', classes, 'POLYGON'), 'modul', folder, layer)
+            with open(folder + '/themes/theme-modul_lag.xml') as f:
+                theme = f.read()
+        finally:
+            shutil.rmtree(folder)
+        self.assertIn("<name>a, c</name>", theme)
+        self.assertIn("<expression>('[felt]' in 'a,c')</expression>", theme)
+        self.assertEqual(theme.count('<class>'), 1)
+
+    def test_classitem_expressions(self):
+        """Test values matched against a classitem keep their meaning."""
+        expression = builders.classitem_expression
+        self.assertEqual(expression('felt', ['Bolig']), 'Bolig')
+        self.assertEqual(expression('felt', ['12'], True), '([felt] = 12)')
+        self.assertEqual(expression('felt', ['-3.5'], True), '([felt] = -3.5)')
+        # a string field keeps the exact value
+        self.assertEqual(expression('felt', ['1.50']), '1.50')
+        self.assertEqual(expression('felt', ['2.0']), '2.0')
+        self.assertEqual(expression('felt', ['012']), '012')
+        self.assertEqual(expression('felt', ['a', 'c']), '{a,c}')
+        self.assertEqual(expression('felt', ['(a)']), "('[felt]' eq '(a)')")
+        self.assertEqual(expression('felt', ['']), "('[felt]' eq '')")
+        self.assertEqual(expression('felt', ['a', '/c']), "('[felt]' in 'a,/c')")
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(CompactionTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,123 @@
+# coding=utf-8
+"""Frequency ordered classes test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'mortenwinther.fuglsang@sweco.dk'
+__date__ = '2017-02-13'
+__copyright__ = 'Copyright 2017, Sweco'
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import frequency
+import qgs_export
+import spec
+
+PROJECT = os.path.join(os.path.dirname(__file__), 'test_project.qgs')
+
+RANGES = [{'lower': '0.000000', 'upper': '10.000000', 'label': '0 - 10'},
+          {'lower': '10.000000', 'upper': '100.000000', 'label': '10 - 100'},
+          {'lower': '100.000000', 'upper': '1000.000000', 'label': '100 - 1000'}]
+
+
+class FrequencyTest(unittest.TestCase):
+    """Test classes are ordered by the frequency of their values."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.folder = tempfile.mkdtemp()
+        self.module_path = self.folder + '/testmodul'
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.folder)
+
+    def database(self):
+        """A sqlite database standing in for the postgis database of the
+        test project, its tables are attached as the public schema.
+        """
+        path = self.folder + '/gis.sqlite'
+        db = sqlite3.connect(path)
+        db.execute('CREATE TABLE bygninger (gid INTEGER PRIMARY KEY, anvendelse TEXT)')
+        db.execute('CREATE TABLE veje (gid INTEGER PRIMARY KEY, hastighed REAL)')
+        for value, count in (('Bolig', 3), ('Erhverv', 10), ('Blandet', 50), (None, 99)):
+            db.executemany('INSERT INTO bygninger (anvendelse) VALUES (?)', [(value,)] * count)
+        for value in (5, 50, 50, 500, 500, 700):
+            db.execute('INSERT INTO veje (hastighed) VALUES (?)', (value,))
+        db.commit()
+        db.close()
+
+        def connect(conn):
+            connection = sqlite3.connect(':memory:')
+            connection.execute("ATTACH DATABASE '" + path + "' AS public")
+            return connection
+        return connect
+
+    def test_count_values(self):
+        """Test values are counted in the database, without NULL."""
+        module = spec.ModuleSpec('testmodul', self.module_path, {})
+        qgs_export.ProjectReader(module).read(PROJECT)
+        frequency.query(module, self.database())
+        self.assertEqual(module.by_name['matrikler'].frequencies, None)
+        self.assertEqual(module.by_name['bygninger'].frequencies, {'Bolig': 3, 'Erhverv': 10, 'Blandet': 50})
+        self.assertEqual(module.by_name['veje'].frequencies, {'5': 1, '50': 2, '500': 2, '700': 1})
+
+    def test_count_subset(self):
+        """Test only the rows of the subset filter are counted."""
+        connection = self.database()(None)
+        try:
+            counts = frequency.count_values(connection, 'public.bygninger', 'anvendelse', "anvendelse <> 'Blandet'")
+        finally:
+            connection.close()
+        self.assertEqual(counts, {'Bolig': 3, 'Erhverv': 10})
+
+    def test_ranges(self):
+        """Test ranges are counted with the bounds of their expression."""
+        classes, notes = frequency.reorder('Graduatedsymbol', RANGES, {'10': 4, '9.5': 1, '1000': 9}, 'hastighed')
+        self.assertEqual([style['label'] for style in classes], ['10 - 100', '0 - 10', '100 - 1000'])
+        self.assertEqual(notes[1:], ['    10 - 100: 4', '    0 - 10: 1', '    100 - 1000: 0'])
+
+    def test_overlapping_ranges(self):
+        """Test overlapping ranges keep their order."""
+        overlapping = RANGES + [{'lower': '50', 'upper': '60', 'label': '50 - 60'}]
+        classes, notes = frequency.reorder('Graduatedsymbol', overlapping, {'55': 10}, 'hastighed')
+        self.assertEqual(classes, overlapping)
+        self.assertIn('overlap', notes[0])
+
+    def test_export(self):
+        """Test an export orders the classes and records it in read.me."""
+        statistics = self.folder + '/statistik.json'
+        with open(statistics, 'w') as f:
+            json.dump({'bygninger': {'Bolig': 3, 'Erhverv': 10, 'Blandet': 50},
+                       'veje': {'5': 1, '50': 2, '500': 7}}, f)
+        options = {'include': 'true', 'presentations': 'true', 'targets': 'true', 'statistics': statistics}
+        qgs_export.export(PROJECT, self.folder, 'testmodul', options=options)
+        with open(self.module_path + '/themes/theme-testmodul_bygninger.xml') as f:
+            theme = f.read()
+        self.assertTrue(theme.index('<name>Blandet</name>') < theme.index('<name>Erhverv</name>') <
+                        theme.index('<name>Bolig</name>'))
+        with open(self.module_path + '/read.me') as f:
+            readme = f.read()
+        self.assertIn('theme-testmodul_veje:\nClasses ordered by the frequency of hastighed', readme)
+        self.assertIn('    Blandet: 50\n    Erhverv: 10\n    Bolig: 3\n', readme)
+        # an update of unchanged layers keeps the notes
+        os.remove(self.module_path + '/read.me')
+        options['update'] = 'true'
+        qgs_export.export(PROJECT, self.folder, 'testmodul', options=options)
+        with open(self.module_path + '/read.me') as f:
+            self.assertEqual(f.read(), readme)
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(FrequencyTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,140 @@
+# coding=utf-8
+"""Generalized geometry test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'mortenwinther.fuglsang@sweco.dk'
+__date__ = '2017-02-13'
+__copyright__ = 'Copyright 2017, Sweco'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import generalize
+import qgs_export
+import spec
+
+PROJECT = os.path.join(os.path.dirname(__file__), 'test_project.qgs')
+
+
+class GeneralizeTest(unittest.TestCase):
+    """Test polygon and line themes switch to simplified geometry by scale."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.folder = tempfile.mkdtemp()
+        self.module_path = self.folder + '/testmodul'
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.folder)
+
+    def test_parse_bands(self):
+        """Test scale bands are sorted and get a default tolerance."""
+        self.assertEqual(generalize.parse_bands('100000:25, 25000'), [(25000, 5.0), (100000, 25.0)])
+        self.assertEqual(generalize.parse_bands(''), [])
+        self.assertEqual(generalize.parse_bands(None), [])
+        for text in ('x', '25000:x', '-5', '25000:0'):
+            self.assertRaises(ValueError, generalize.parse_bands, text)
+
+    def test_theme_bands(self):
+        """Test the theme layers are cut to the scale band of the layer."""
+        bands = [(25000, 5.0), (100000, 25.0)]
+        self.assertEqual(generalize.theme_bands(bands), [
+            ('', (0, 25000)), ('_25000', (25000, 100000)), ('_100000', (100000, 0))])
+        self.assertEqual(generalize.theme_bands(bands, (500.0, 50000.0)), [
+            ('', (500.0, 25000)), ('_25000', (25000, 50000.0))])
+        self.assertEqual(generalize.theme_bands(bands, (30000.0, 0.0)), [
+            ('_25000', (30000.0, 100000)), ('_100000', (100000, 0.0))])
+
+    def layer(self, name, sql, attribute='anvendelse'):
+        connection = {'type': 'MultiPolygon', 'table': 'public.bygninger', 'key': 'gid', 'geom': 'geom',
+                      'dbname': 'gis', 'host': 'localhost', 'port': '5432', 'user': 'gis',
+                      'displayname': name, 'sql': sql}
+        return spec.LayerSpec(name, name, name, 'Categorizedsymbol', connection,
+                              attribute=attribute, fields=['gid', 'anvendelse'])
+
+    def test_layers_on_one_table(self):
+        """Test layers filtering the same table get views of their own."""
+        module = spec.ModuleSpec('mod', self.module_path, {})
+        module.add(self.layer('boliger', "anvendelse='Bolig'"))
+        module.add(self.layer('erhverv', "anvendelse='Erhverv'"))
+        views = generalize.views(module, [(25000, 5.0)])
+        self.assertEqual(views, {'boliger': [('ds_mod_boliger_25000', 'public.bygninger_mod_boliger_gen25000')],
+                                 'erhverv': [('ds_mod_erhverv_25000', 'public.bygninger_mod_erhverv_gen25000')]})
+        sql = generalize.scripts(module, [(25000, 5.0)])['ep_mod_gis']
+        self.assertIn('CREATE MATERIALIZED VIEW "public"."bygninger_mod_boliger_gen25000" AS\n'
+                      '  SELECT "gid", "anvendelse", ST_SimplifyPreserveTopology("geom", 5.0) AS "geom"\n'
+                      '  FROM "public"."bygninger"\n'
+                      '  WHERE (anvendelse=\'Bolig\') AND "geom" IS NOT NULL;', sql)
+        self.assertIn('"public"."bygninger_mod_erhverv_gen25000" AS', sql)
+        # names postgres would cut stay apart
+        long_names = [generalize.view_name('public.bygninger', 'mod', 'lag_' + 'x' * 60 + str(i), 25000)
+                      for i in range(2)]
+        self.assertNotEqual(long_names[0], long_names[1])
+        self.assertEqual(len(long_names[0]), len('public.') + generalize.IDENTIFIER_LENGTH)
+
+    def test_script_per_endpoint(self):
+        """Test the views are created by one script per database."""
+        module = spec.ModuleSpec('mod', self.module_path, {})
+        module.add(self.layer('boliger', None))
+        module.add(self.layer('skel', None)).connection['host'] = 'kort'
+        scripts = generalize.scripts(module, [(25000, 5.0)])
+        self.assertEqual(sorted(scripts), ['ep_mod_gis', 'ep_mod_gis_2'])
+        self.assertIn('-- Run against database gis on kort:5432', scripts['ep_mod_gis_2'])
+        self.assertIn('bygninger_mod_skel_gen25000', scripts['ep_mod_gis_2'])
+        self.assertNotIn('boliger', scripts['ep_mod_gis_2'])
+        self.assertNotIn('skel', scripts['ep_mod_gis'])
+
+    def test_expression_layer(self):
+        """Test a layer classified by an expression keeps its geometry."""
+        module = spec.ModuleSpec('mod', self.module_path, {})
+        module.add(self.layer('boliger', "anvendelse='Bolig'"))
+        module.add(self.layer('etager', None, attribute='"etager" + 1'))
+        self.assertFalse(generalize.generalized(module.by_name['etager']))
+        self.assertEqual(sorted(generalize.views(module, [(25000, 5.0)])), ['boliger'])
+        self.assertNotIn('etager', generalize.scripts(module, [(25000, 5.0)])['ep_mod_gis'])
+
+    def test_export(self):
+        """Test the datasources, themes and SQL of a generalized module."""
+        options = {'include': 'true', 'presentations': 'true', 'targets': 'true', 'generalize': '25000:5,100000'}
+        qgs_export.export(PROJECT, self.folder, 'testmodul', options=options)
+        with open(self.module_path + '/datasources/datasources.xml') as f:
+            datasources = f.read()
+        self.assertIn('<datasource endpoint="ep_testmodul_gis" name="ds_testmodul_veje_100000">\n'
+                      '    <table geometrycolumn="geom" pkcolumn="gid" name="public.veje_testmodul_veje_gen100000"></table>',
+                      datasources)
+        self.assertNotIn('bygninger_gen', datasources)
+        with open(self.module_path + '/themes/theme-testmodul_veje.xml') as f:
+            theme = f.read()
+        self.assertEqual(theme.count('<layer '), 3)
+        self.assertEqual(theme.count('<name>10 - 100</name>'), 3)
+        self.assertIn('name="testmodul_veje_25000">\n[datasource:ds_testmodul_veje_25000.mapfile-datasource]\n'
+                      '    <minscale>25000</minscale>\n    <maxscale>100000</maxscale>\n', theme)
+        with open(self.module_path + '/themes/theme-testmodul_bygninger.xml') as f:
+            self.assertEqual(f.read().count('<layer '), 1)
+        self.assertEqual(os.listdir(self.module_path + '/sql'), ['generalize-ep_testmodul_gis.sql'])
+        with open(self.module_path + '/sql/generalize-ep_testmodul_gis.sql') as f:
+            sql = f.read()
+        self.assertIn('CREATE MATERIALIZED VIEW "public"."veje_testmodul_veje_gen100000" AS\n'
+                      '  SELECT "gid", "hastighed", ST_SimplifyPreserveTopology("geom", 20.0) AS "geom"\n'
+                      '  FROM "public"."veje"\n', sql)
+        self.assertNotIn('bygninger', sql)
+        # the script goes when the module is updated without generalization
+        options.update({'generalize': '', 'update': 'true'})
+        qgs_export.export(PROJECT, self.folder, 'testmodul', options=options)
+        self.assertEqual(os.listdir(self.module_path + '/sql'), [])
+        with open(self.module_path + '/themes/theme-testmodul_veje.xml') as f:
+            self.assertEqual(f.read().count('<layer '), 1)
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(GeneralizeTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
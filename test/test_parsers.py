@@ -0,0 +1,143 @@
+# coding=utf-8
+"""Layer style parser test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'mortenwinther.fuglsang@sweco.dk'
+__date__ = '2017-02-13'
+__copyright__ = 'Copyright 2017, Sweco'
+
+import unittest
+
+import parsers
+
+CATEGORIZED = '''<!DOCTYPE qgis PUBLIC 'http://mrcc.com/qgis.dtd' 'SYSTEM'>
+<qgis version="2.18.0">
+  <renderer-v2 attr="anvendelse" symbollevels="0" type="categorizedSymbol">
+    <categories>
+%s
+    </categories>
+    <symbols>
+%s
+    </symbols>
+  </renderer-v2>
+</qgis>'''
+
+CATEGORY = '      <category render="true" symbol="%d" value="%s" label="%s"/>'
+
+SYMBOL = '''      <symbol alpha="1" type="marker" name="%d">
+        <layer pass="0" class="SimpleMarker" locked="0">
+          <prop k="color" v="%d,0,0,255"/>
+        </layer>
+      </symbol>'''
+
+
+def categorized(values, order=None):
+    categories = '\n'.join(CATEGORY % (i, value, value) for i, value in enumerate(values))
+    symbols = '\n'.join(SYMBOL % (i, i) for i in (order or range(len(values))))
+    return CATEGORIZED % (categories, symbols)
+
+
+class ParsersTest(unittest.TestCase):
+    """Test the renderer classes are read from a layer style."""
+
+    def test_categories_find_their_symbol(self):
+        """Test every category gets the props of its own symbol."""
+        style = parsers.layer_style(categorized(['Bolig', 'Erhverv', 'Blandet'], order=[2, 0, 1]))
+        self.assertEqual(style['renderer'], 'Categorizedsymbol')
+        self.assertEqual([(c['value'], c['color']) for c in style['classes']],
+                         [('Bolig', '0,0,0,255'), ('Erhverv', '1,0,0,255'), ('Blandet', '2,0,0,255')])
+
+    def test_single_category(self):
+        """Test a style with one category and one symbol."""
+        style = parsers.layer_style(categorized(['Bolig']))
+        self.assertEqual(len(style['classes']), 1)
+        self.assertEqual(style['classes'][0]['attribute'], 'anvendelse')
+
+    def test_category_without_symbol(self):
+        """Test a category pointing at a missing symbol is left out."""
+        style = parsers.layer_style(categorized(['Bolig', 'Erhverv'], order=[1]))
+        self.assertEqual([c['value'] for c in style['classes']], ['Erhverv'])
+
+    def test_only_renderer_and_edittypes(self):
+        """Test symbol layers, sub symbols and other elements are left out."""
+        qml = categorized(['Bolig']).replace(
+            '</layer>',
+            '<symbol name="@0@0"><layer><prop k="color" v="9,9,9,255"/></layer></symbol>'
+            '</layer><layer><prop k="color" v="8,8,8,255"/></layer>', 1)
+        qml = qml.replace('<renderer-v2', '<edittypes><edittype name="id"/><edittype name="navn"/></edittypes>'
+                          '<labeling type="simple"/><renderer-v2')
+        parsed = parsers.StyleReader().read(qml)
+        self.assertEqual(sorted(parsed), ['edittypes', 'renderer-v2'])
+        symbol = parsed['renderer-v2']['symbols']['symbol'][0]
+        self.assertEqual(symbol['layer'], {'prop': [{'@k': 'color', '@v': '0,0,0,255'}]})
+        self.assertEqual(parsers.layer_style(qml)['fields'], ['id', 'navn'])
+
+    def test_scale_band(self):
+        """Test the scale band is only read from layers with scale visibility."""
+        qml = categorized(['Bolig'])
+        self.assertEqual(parsers.layer_style(qml)['scale'], None)
+        scaled = qml.replace('<qgis version="2.18.0">', '<qgis version="2.18.0" minimumScale="%s" '
+                             'maximumScale="%s" hasScaleBasedVisibilityFlag="%s">')
+        self.assertEqual(parsers.layer_style(scaled % ('0', '1e+08', '0'))['scale'], None)
+        self.assertEqual(parsers.layer_style(scaled % ('500', '25000', '1'))['scale'], (500.0, 25000.0))
+        self.assertEqual(parsers.layer_style(scaled % ('0', '25000', '1'))['scale'], (0.0, 25000.0))
+        self.assertEqual(parsers.layer_style(scaled % ('25000', '500', '1'))['scale'], (25000.0, 0.0))
+        self.assertEqual(parsers.layer_style(scaled % ('0', '0', '1'))['scale'], None)
+
+    def test_source_subset(self):
+        """Test the subset filter of a layer source keeps its quotes."""
+        conn = parsers.source('dbname=\'gis\' host=localhost port=5432 user=\'gis\' password=\'secret\' '
+                              'sslmode=disable key=\'gid\' srid=25832 type=Point table="public"."bygninger" (geom) '
+                              'sql="anvendelse" = \'Bolig\' AND "etager" > 2')
+        self.assertEqual(conn['table'], 'public.bygninger')
+        self.assertEqual(conn['geom'], 'geom')
+        self.assertEqual(conn['sql'], '"anvendelse" = \'Bolig\' AND "etager" > 2')
+        conn = parsers.source('dbname=\'gis\' host=localhost port=5432 user=\'gis\' password=\'secret\' '
+                              'key=\'gid\' srid=25832 type=Point table="public"."bygninger" (geom) sql=')
+        self.assertNotIn('sql', conn)
+
+    def test_source_quoted_values(self):
+        """Test quoted values keep their spaces and escaped quotes."""
+        conn = parsers.source('dbname=\'kort data\' host=db.example port=5432 user=\'gis\' '
+                              'password=\'hem lig\\\'t\' key="gid" srid=25832 type=Point '
+                              'table="min schema"."by ""x""" ("the geom") sql=')
+        self.assertEqual(conn['dbname'], 'kort data')
+        self.assertEqual(conn['password'], "hem lig't")
+        self.assertEqual(conn['key'], 'gid')
+        self.assertEqual(conn['table'], 'min schema.by "x"')
+        self.assertEqual(conn['geom'], 'the geom')
+        self.assertRaises(KeyError, parsers.source, '/data/lokalplaner.shp')
+
+    def test_source_cache(self):
+        """Test a layer source is only parsed again when it changes."""
+        cache = parsers.SourceCache()
+        postgis = 'dbname=\'gis\' host=localhost port=5432 user=\'gis\' password=\'secret\' ' \
+                  'key=\'gid\' srid=25832 type=Point table="public"."bygninger" (geom) sql='
+        parsed = []
+        source = parsers.source
+
+        def counting_source(layer_source):
+            parsed.append(layer_source)
+            return source(layer_source)
+        parsers.source = counting_source
+        try:
+            conn = cache.source('lag1', postgis)
+            conn['layername'] = 'bygninger'
+            self.assertNotIn('layername', cache.source('lag1', postgis))
+            self.assertRaises(KeyError, cache.source, 'lag2', '/data/lokalplaner.shp')
+            self.assertRaises(KeyError, cache.source, 'lag2', '/data/lokalplaner.shp')
+            self.assertEqual(cache.source('lag1', postgis.replace('bygninger', 'veje'))['table'], 'public.veje')
+        finally:
+            parsers.source = source
+        self.assertEqual(len(parsed), 3)
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(ParsersTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
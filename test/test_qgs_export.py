@@ -0,0 +1,368 @@
+# coding=utf-8
+"""Command line exporter test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'mortenwinther.fuglsang@sweco.dk'
+__date__ = '2017-02-13'
+__copyright__ = 'Copyright 2017, Sweco'
+
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+import exporter
+import parsers
+import profiling
+import qgs_export
+import spec
+import tracing
+
+PROJECT = os.path.join(os.path.dirname(__file__), 'test_project.qgs')
+
+
+class QgsExportTest(unittest.TestCase):
+    """Test a module can be exported from a .qgs file without QGIS."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.folder = tempfile.mkdtemp()
+        self.module_path = self.folder + '/testmodul'
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.folder)
+
+    def test_export(self):
+        """Test all compatible postgis layers become themes."""
+        results = qgs_export.export(PROJECT, self.folder, 'testmodul')
+        self.assertEqual(results, [('matrikler', None), ('bygninger', None), ('veje', None)])
+        themes = sorted(os.listdir(self.module_path + '/themes'))
+        self.assertEqual(themes, [
+            'theme-testmodul_bygninger.xml',
+            'theme-testmodul_matrikler.xml',
+            'theme-testmodul_veje.xml'])
+        for name in ('datasources/datasources.xml',
+                     'presentations/pres-testmodul_veje.xml',
+                     'queries/targetset-testmodul.xml',
+                     'profiles/includes/themes.xml',
+                     'read.me'):
+            self.assertTrue(os.path.isfile(self.module_path + '/' + name), name)
+        self.assertFalse(os.path.exists(self.module_path + '/qml'))
+        with open(self.module_path + '/themes/theme-testmodul_bygninger.xml') as f:
+            theme = f.read()
+        self.assertIn('[datasource:ds_testmodul_bygninger.mapfile-datasource]', theme)
+        self.assertIn("('[anvendelse]' eq 'Erhverv')", theme)
+
+    def test_process_pool(self):
+        """Test themes built in a process pool match the serial build."""
+        qgs_export.export(PROJECT, self.folder, 'serial')
+        options = {'include': 'true', 'presentations': 'true', 'targets': 'true', 'processes': 3}
+        results = qgs_export.export(PROJECT, self.folder, 'testmodul', options=options)
+        self.assertEqual([error for layer, error in results], [None, None, None])
+        for layer in ('matrikler', 'bygninger', 'veje'):
+            with open(self.folder + '/serial/themes/theme-serial_' + layer + '.xml') as f:
+                serial = f.read().replace('serial', 'testmodul')
+            with open(self.module_path + '/themes/theme-testmodul_' + layer + '.xml') as f:
+                self.assertEqual(f.read(), serial)
+        self.assertEqual(os.listdir(self.module_path + '/temp'), [])
+
+    def test_theme_layout(self):
+        """Test a streamed theme keeps the layout of the indented themes."""
+        qgs_export.export(PROJECT, self.folder, 'testmodul', selected=['matrikler'])
+        with open(self.module_path + '/themes/theme-testmodul_matrikler.xml') as f:
+            theme = f.read()
+        self.assertEqual(theme, '\n'.join([
+            '<?xml version="1.0" encoding="ISO-8859-1"?>',
+            '<theme>',
+            '  <cbinfo-metadata>',
+            '    <param name="copyright-text"></param>',
+            '  </cbinfo-metadata>',
+            '  <clientlayers>',
+            '    <clientlayer>',
+            '      <singletile>true</singletile>',
+            '    </clientlayer>',
+            '  </clientlayers>',
+            '  <layer type="POLYGON" datasource="ds_testmodul_matrikler" name="testmodul_matrikler">',
+            '[datasource:ds_testmodul_matrikler.mapfile-datasource]',
+            '    <class>',
+            '      <name>matrikler</name>',
+            '      <style><opacity>100</opacity><color>255 0 0</color>'
+            '<outlinecolor>35 35 35</outlinecolor><outlinewidth>2.0</outlinewidth></style>',
+            '    </class>',
+            '  </layer>',
+            '</theme>']))
+        self.assertEqual(os.listdir(self.module_path + '/temp'), [])
+
+    def test_classitem(self):
+        """Test categorized themes can match plain values against a classitem."""
+        options = {'include': 'true', 'presentations': 'true', 'targets': 'true', 'classitem': 'true'}
+        qgs_export.export(PROJECT, self.folder, 'testmodul', options=options)
+        with open(self.module_path + '/themes/theme-testmodul_bygninger.xml') as f:
+            theme = f.read()
+        self.assertIn('name="testmodul_bygninger" classitem="anvendelse">', theme)
+        self.assertIn('<expression>Erhverv</expression>', theme)
+        self.assertNotIn(' eq ', theme)
+        with open(self.module_path + '/themes/theme-testmodul_veje.xml') as f:
+            self.assertNotIn('classitem', f.read())
+
+    def test_scale_visibility(self):
+        """Test layers with scale based visibility get their scale band."""
+        with open(PROJECT) as f:
+            project = f.read().replace('<maplayer minimumScale="0" maximumScale="1e+08" geometry="Line" type="vector" '
+                                       'hasScaleBasedVisibilityFlag="0">',
+                                       '<maplayer minimumScale="500" maximumScale="25000" geometry="Line" type="vector" '
+                                       'hasScaleBasedVisibilityFlag="1">')
+        scaled = self.folder + '/scaled.qgs'
+        with open(scaled, 'w') as f:
+            f.write(project)
+        qgs_export.export(scaled, self.folder, 'testmodul')
+        with open(self.module_path + '/themes/theme-testmodul_veje.xml') as f:
+            self.assertIn('.mapfile-datasource]\n    <minscale>500</minscale>\n    <maxscale>25000</maxscale>\n    <class>',
+                          f.read())
+        with open(self.module_path + '/themes/theme-testmodul_bygninger.xml') as f:
+            self.assertNotIn('scale>', f.read())
+
+    def test_datasource_subset(self):
+        """Test datasources read the used columns and the filtered rows."""
+        with open(PROJECT) as f:
+            project = f.read().replace('&quot;bygninger&quot; (geom) sql=',
+                                       '&quot;bygninger&quot; (geom) sql=&quot;anvendelse&quot; &lt;&gt; \'Blandet\'')
+        filtered = self.folder + '/filtered.qgs'
+        with open(filtered, 'w') as f:
+            f.write(project)
+        options = {'include': 'true', 'presentations': 'false', 'targets': 'true'}
+        qgs_export.export(filtered, self.folder, 'testmodul', options=options)
+        with open(self.module_path + '/datasources/datasources.xml') as f:
+            datasources = f.read().replace('&quot;', '"')
+        self.assertIn('name="(SELECT "gid", "anvendelse", "geom" FROM "public"."bygninger" '
+                      'WHERE "anvendelse" &lt;> \'Blandet\') AS "bygninger""', datasources)
+        self.assertIn('name="(SELECT "gid", "geom" FROM "public"."matrikler") AS "matrikler""', datasources)
+
+    def test_endpoints(self):
+        """Test one endpoint per host, port, database and user."""
+        with open(PROJECT) as f:
+            project = f.read().replace("host=localhost port=5432 user='gis' password='secret' sslmode=disable "
+                                       "key='gid' srid=25832 type=MultiLineString",
+                                       "host=db2 port=5432 user='gis' password='secret' sslmode=disable "
+                                       "key='gid' srid=25832 type=MultiLineString")
+        hosts = self.folder + '/hosts.qgs'
+        with open(hosts, 'w') as f:
+            f.write(project)
+        options = {'include': 'true', 'presentations': 'true', 'targets': 'true', 'pool': 'maxconnections=10'}
+        qgs_export.export(hosts, self.folder, 'testmodul', options=options)
+        with open(self.module_path + '/datasources/datasources.xml') as f:
+            datasources = f.read()
+        self.assertEqual(datasources.count('<endpoint '), 2)
+        self.assertIn('<endpoint name="ep_testmodul_gis_2" endpointtype="postgis">\n'
+                      '    <connect>db2:5432/gis</connect>\n'
+                      '    <user>gis</user>\n'
+                      '    <pwd>secret</pwd>\n'
+                      '    <maxconnections>10</maxconnections>\n', datasources)
+        self.assertIn('<datasource endpoint="ep_testmodul_gis" name="ds_testmodul_bygninger">', datasources)
+        self.assertIn('<datasource endpoint="ep_testmodul_gis_2" name="ds_testmodul_veje">', datasources)
+
+    def test_style_parsed_once(self):
+        """Test every layer style is parsed once for theme and presentation."""
+        parsed = []
+        create = parsers.expat.ParserCreate
+
+        def counting_create(*args, **kwargs):
+            parsed.append(args)
+            return create(*args, **kwargs)
+        parsers.expat.ParserCreate = counting_create
+        try:
+            qgs_export.export(PROJECT, self.folder, 'testmodul')
+        finally:
+            parsers.expat.ParserCreate = create
+        # the project itself and one parse per layer style
+        self.assertEqual(len(parsed), 4)
+        with open(self.module_path + '/presentations/pres-testmodul_veje.xml') as f:
+            self.assertIn('<value>hastighed</value>', f.read())
+
+    def test_qml_copies(self):
+        """Test the layer styles are written to qml when asked for."""
+        options = {'include': 'false', 'presentations': 'false', 'targets': 'false', 'qml': 'true'}
+        qgs_export.export(PROJECT, self.folder, 'testmodul', options=options)
+        qmls = sorted(os.listdir(self.module_path + '/qml'))
+        self.assertEqual(qmls, ['bygninger.qml', 'matrikler.qml', 'veje.qml'])
+
+    def module(self, options):
+        module = spec.ModuleSpec('testmodul', self.module_path, options)
+        qgs_export.ProjectReader(module).read(PROJECT)
+        return module
+
+    def test_progress(self):
+        """Test every stage and theme is reported to the progress callback."""
+        options = {'include': 'true', 'presentations': 'true', 'targets': 'true'}
+        reported = []
+        exporter.build(self.module(options), progress=lambda *args: reported.append(args))
+        self.assertEqual(reported, [('datasources', 0, 1), ('themes', 0, 3), ('themes', 1, 3), ('themes', 2, 3),
+                                    ('themes', 3, 3), ('targets', 0, 1), ('includes', 0, 1), ('read.me', 0, 1)])
+
+    def test_cancel(self):
+        """Test a cancelled new module is discarded, and a cancelled update
+        keeps the finished themes for the next update."""
+        options = {'include': 'true', 'presentations': 'true', 'targets': 'true'}
+        done = []
+        self.assertRaises(exporter.Cancelled, exporter.build, self.module(options),
+                          theme_done=done.append, cancelled=lambda: len(done) == 1)
+        self.assertFalse(os.path.exists(self.module_path))
+        options['update'] = 'true'
+        done = []
+        try:
+            exporter.build(self.module(options), theme_done=done.append, cancelled=lambda: len(done) == 1)
+            self.fail('build was not cancelled')
+        except exporter.Cancelled as cancelled:
+            self.assertEqual(cancelled.results, [('matrikler', None)])
+        self.assertEqual(os.listdir(self.module_path + '/themes'), ['theme-testmodul_matrikler.xml'])
+        self.assertFalse(os.path.exists(self.module_path + '/read.me'))
+        done = []
+        exporter.build(self.module(options), theme_done=done.append)
+        self.assertEqual(sorted(os.listdir(self.module_path + '/themes')), [
+            'theme-testmodul_bygninger.xml', 'theme-testmodul_matrikler.xml', 'theme-testmodul_veje.xml'])
+        self.assertTrue(os.path.isfile(self.module_path + '/read.me'))
+
+    def test_trace(self):
+        """Test a traced build writes the spans of every stage and layer,
+        also from the workers of a process pool."""
+        for processes in (1, 2):
+            options = {'include': 'true', 'presentations': 'true', 'targets': 'true',
+                       'processes': processes, 'trace': 'true'}
+            exporter.build(self.module(options))
+            path = self.module_path + '/' + exporter.TRACE_FILE
+            with open(path) as f:
+                events = json.load(f)['traceEvents']
+            names = [event['name'] for event in events]
+            for name in ('build', 'datasources', 'themes', 'targets', 'includes', 'read.me', 'manifest',
+                         'parse', 'indent', 'builders.categorized', 'builders.presentation'):
+                self.assertIn(name, names)
+            layers = sorted(event['args']['layer'] for event in events if event['name'] == 'layer')
+            self.assertEqual(layers, ['bygninger', 'matrikler', 'veje'])
+            self.assertTrue(all(event['ph'] == 'X' and event['dur'] >= 0 for event in events))
+            self.assertEqual(len(tracing.summary(path)), tracing.SUMMARY_SPANS + 1)
+            shutil.rmtree(self.module_path)
+        self.assertIsNone(tracing.active())
+
+    def test_failed_trace(self):
+        """Test the trace of a failed new module is kept outside the
+        discarded staging folder."""
+        options = {'include': 'true', 'presentations': 'true', 'targets': 'true', 'trace': 'true'}
+        readme_builder = exporter.builders.readme
+
+        def failing_readme(module, notes=None):
+            raise IOError('disken er fuld')
+        exporter.builders.readme = failing_readme
+        try:
+            self.assertRaises(IOError, exporter.build, self.module(options))
+        finally:
+            exporter.builders.readme = readme_builder
+        self.assertFalse(os.path.exists(self.module_path))
+        path = exporter.trace_file(self.module_path, 'testmodul')
+        self.assertEqual(os.path.dirname(path), tempfile.gettempdir())
+        try:
+            with open(path) as f:
+                names = [event['name'] for event in json.load(f)['traceEvents']]
+        finally:
+            os.remove(path)
+        self.assertIn('build', names)
+        self.assertIn('themes', names)
+
+    def test_profile(self):
+        """Test a profiled build writes a profile and a memory snapshot of
+        every stage, also when asked for by the environment variable."""
+        options = {'include': 'true', 'presentations': 'true', 'targets': 'true', 'processes': 2}
+        os.environ[profiling.PROFILE_VARIABLE] = '1'
+        try:
+            exporter.build(self.module(options))
+        finally:
+            del os.environ[profiling.PROFILE_VARIABLE]
+        folder = self.module_path + '/' + exporter.PROFILE_FOLDER
+        for name in ('fingerprints', 'datasources', 'themes', 'targets', 'includes', 'read.me', 'manifest'):
+            self.assertTrue(os.path.isfile(folder + '/' + name + '-memory.txt'))
+            with open(folder + '/' + name + '-memory.txt') as f:
+                self.assertTrue(f.readline().startswith('Stage: ' + name))
+        # the layer jobs are profiled in the themes stage
+        functions = [function for filename, line, function in pstats.Stats(folder + '/themes.pstats').stats]
+        self.assertIn('layer_job', functions)
+        shutil.rmtree(self.module_path)
+        exporter.build(self.module(options))
+        self.assertEqual(os.listdir(self.module_path + '/temp'), [])
+
+    def test_failed_build(self):
+        """Test a failed update leaves the module as it was."""
+        qgs_export.export(PROJECT, self.folder, 'testmodul')
+        with open(self.module_path + '/read.me') as f:
+            readme = f.read()
+        os.remove(self.module_path + '/themes/theme-testmodul_veje.xml')
+        options = {'include': 'true', 'presentations': 'true', 'targets': 'true', 'update': 'true'}
+        readme_builder = exporter.builders.readme
+
+        def failing_readme(module, notes=None):
+            raise IOError('disken er fuld')
+        exporter.builders.readme = failing_readme
+        try:
+            self.assertRaises(IOError, qgs_export.export, PROJECT, self.folder, 'testmodul', options=options)
+        finally:
+            exporter.builders.readme = readme_builder
+        self.assertEqual(os.listdir(self.folder), ['testmodul'])
+        self.assertFalse(os.path.exists(self.module_path + '/themes/theme-testmodul_veje.xml'))
+        with open(self.module_path + '/read.me') as f:
+            self.assertEqual(f.read(), readme)
+
+    def test_update(self):
+        """Test an update only rewrites the files of changed layers."""
+        qgs_export.export(PROJECT, self.folder, 'testmodul')
+        files = []
+        for root, dirs, names in os.walk(self.module_path):
+            files.extend(os.path.join(root, name) for name in names)
+        for name in files:
+            os.utime(name, (0, 0))
+        inodes = dict((name, os.stat(name).st_ino) for name in files)
+        with open(PROJECT) as f:
+            project = f.read().replace('253,141,60,255', '0,0,255,255')
+        changed = self.folder + '/changed.qgs'
+        with open(changed, 'w') as f:
+            f.write(project)
+        options = {'include': 'true', 'presentations': 'true', 'targets': 'true', 'update': 'true'}
+        results = qgs_export.export(changed, self.folder, 'testmodul', options=options)
+        self.assertEqual([error for layer, error in results], [None, None, None])
+        touched = sorted(os.path.relpath(name, self.module_path) for name in files if os.path.getmtime(name) != 0)
+        self.assertEqual(touched, ['qgis2sps-manifest.json', 'themes/theme-testmodul_veje.xml'])
+        # the files that did not change are left in place
+        moved = sorted(os.path.relpath(name, self.module_path) for name in files if os.stat(name).st_ino != inodes[name])
+        self.assertEqual(moved, ['qgis2sps-manifest.json', 'themes/theme-testmodul_veje.xml'])
+        with open(self.module_path + '/themes/theme-testmodul_veje.xml') as f:
+            self.assertIn('<color>0 0 255</color>', f.read())
+
+    def test_update_removed_layer(self):
+        """Test layers left out of an update are removed from the module."""
+        qgs_export.export(PROJECT, self.folder, 'testmodul')
+        options = {'include': 'true', 'presentations': 'true', 'targets': 'true', 'update': 'true'}
+        qgs_export.export(PROJECT, self.folder, 'testmodul', selected=['veje'], options=options)
+        self.assertEqual(os.listdir(self.module_path + '/themes'), ['theme-testmodul_veje.xml'])
+        self.assertEqual(os.listdir(self.module_path + '/presentations'), ['pres-testmodul_veje.xml'])
+
+    def test_selected_layers(self):
+        """Test only the requested layers are exported."""
+        qgs_export.export(PROJECT, self.folder, 'testmodul', selected=['veje'])
+        themes = os.listdir(self.module_path + '/themes')
+        self.assertEqual(themes, ['theme-testmodul_veje.xml'])
+
+    def test_existing_folder(self):
+        """Test an existing module folder is refused."""
+        os.mkdir(self.module_path)
+        self.assertRaises(IOError, qgs_export.export, PROJECT, self.folder, 'testmodul')
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(QgsExportTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,142 @@
+# coding=utf-8
+"""Staged build test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'mortenwinther.fuglsang@sweco.dk'
+__date__ = '2017-02-13'
+__copyright__ = 'Copyright 2017, Sweco'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import staging
+
+
+class StagingTest(unittest.TestCase):
+    """Test modules are staged locally and published when they are built."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.folder = tempfile.mkdtemp()
+        self.module_path = self.folder + '/testmodul'
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.folder)
+
+    def write(self, path, text):
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_copy_tree(self):
+        """Test files and empty folders are copied with their times."""
+        for i in range(20):
+            self.write(self.module_path + '/themes/theme-' + str(i) + '.xml', str(i))
+        os.makedirs(self.module_path + '/queries')
+        os.utime(self.module_path + '/themes/theme-3.xml', (0, 0))
+        staging.copy_tree(self.module_path, self.folder + '/kopi')
+        self.assertEqual(sorted(os.listdir(self.folder + '/kopi')), ['queries', 'themes'])
+        self.assertEqual(len(os.listdir(self.folder + '/kopi/themes')), 20)
+        self.assertEqual(self.read(self.folder + '/kopi/themes/theme-7.xml'), '7')
+        self.assertEqual(os.path.getmtime(self.folder + '/kopi/themes/theme-3.xml'), 0)
+
+    def test_publish(self):
+        """Test a new module is published from the staging folder."""
+        staged = staging.Staging(self.module_path)
+        self.write(staged.path + '/read.me', 'ny')
+        staged.publish()
+        self.assertEqual(os.listdir(self.folder), ['testmodul'])
+        self.assertEqual(self.read(self.module_path + '/read.me'), 'ny')
+        self.assertFalse(os.path.exists(staged.root))
+
+    def test_publish_update(self):
+        """Test an existing module is staged and updated when published."""
+        self.write(self.module_path + '/read.me', 'gammel')
+        self.write(self.module_path + '/egen.txt', 'egen')
+        staged = staging.Staging(self.module_path)
+        self.assertEqual(self.read(staged.path + '/egen.txt'), 'egen')
+        self.write(staged.path + '/read.me', 'ny')
+        # the module is untouched until it is published
+        self.assertEqual(self.read(self.module_path + '/read.me'), 'gammel')
+        staged.publish()
+        self.assertEqual(os.listdir(self.folder), ['testmodul'])
+        self.assertEqual(self.read(self.module_path + '/read.me'), 'ny')
+        self.assertEqual(self.read(self.module_path + '/egen.txt'), 'egen')
+
+    def test_publish_changes(self):
+        """Test an update only writes the changed files and removes the
+        removed ones, the other files are left as they were."""
+        for name in ('read.me', 'themes/theme-a.xml', 'themes/theme-b.xml', 'queries/q.xml'):
+            self.write(self.module_path + '/' + name, name)
+        os.utime(self.module_path + '/themes/theme-a.xml', (0, 0))
+        before = os.stat(self.module_path + '/themes/theme-a.xml')
+        staged = staging.Staging(self.module_path)
+        self.write(staged.path + '/themes/theme-b.xml', 'ny')
+        # rewritten with the same bytes
+        self.write(staged.path + '/read.me', 'read.me')
+        self.write(staged.path + '/presentations/pres-a.xml', 'a')
+        os.remove(staged.path + '/themes/theme-a.xml')
+        shutil.rmtree(staged.path + '/queries')
+        self.write(staged.path + '/themes/theme-a.xml', 'themes/theme-a.xml')
+        os.utime(staged.path + '/themes/theme-a.xml', (0, 0))
+        readme = os.stat(self.module_path + '/read.me')
+        staged.publish()
+        after = os.stat(self.module_path + '/themes/theme-a.xml')
+        self.assertEqual((after.st_ino, after.st_mtime), (before.st_ino, before.st_mtime))
+        after = os.stat(self.module_path + '/read.me')
+        self.assertEqual((after.st_ino, after.st_mtime), (readme.st_ino, readme.st_mtime))
+        self.assertEqual(self.read(self.module_path + '/themes/theme-b.xml'), 'ny')
+        self.assertEqual(self.read(self.module_path + '/presentations/pres-a.xml'), 'a')
+        self.assertEqual(sorted(os.listdir(self.module_path)), ['presentations', 'read.me', 'themes'])
+        self.assertEqual(os.listdir(self.folder), ['testmodul'])
+
+    def test_failed_publish(self):
+        """Test a publish failing to copy leaves the module as it was."""
+        self.write(self.module_path + '/read.me', 'gammel')
+        staged = staging.Staging(self.module_path)
+        for i in range(10):
+            self.write(staged.path + '/themes/theme-' + str(i) + '.xml', str(i))
+        copy_file = staging.copy_file
+
+        def failing_copy(paths):
+            if paths[0].endswith('theme-5.xml'):
+                raise IOError('netværksfejl')
+            copy_file(paths)
+        staging.copy_file = failing_copy
+        try:
+            self.assertRaises(IOError, staged.publish)
+        finally:
+            staging.copy_file = copy_file
+        self.assertEqual(os.listdir(self.folder), ['testmodul'])
+        self.assertEqual(os.listdir(self.module_path), ['read.me'])
+        self.assertFalse(os.path.exists(staged.root))
+        # a new module does not appear
+        staged = staging.Staging(self.folder + '/nyt')
+        self.write(staged.path + '/themes/theme-1.xml', '1')
+        self.write(staged.path + '/themes/theme-5.xml', '5')
+        staging.copy_file = failing_copy
+        try:
+            self.assertRaises(IOError, staged.publish)
+        finally:
+            staging.copy_file = copy_file
+        self.assertEqual(os.listdir(self.folder), ['testmodul'])
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(StagingTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,90 @@
+# coding=utf-8
+"""Plugin startup test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'mortenwinther.fuglsang@sweco.dk'
+__date__ = '2017-02-13'
+__copyright__ = 'Copyright 2017, Sweco'
+
+import ast
+import os
+import subprocess
+import sys
+import unittest
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Modules QGIS may only load when the plugin is run, not at startup
+DEFERRED = ('builders', 'export_task', 'exporter', 'frequency', 'generalize', 'parsers', 'profiling',
+            'qgis2sps_dialog', 'staging', 'tracing', 'xmltodict', 'yattag', 'PyQt4.QtWebKit',
+            'PyQt4.QtXml')
+
+# Seconds QGIS may spend loading the plugin at startup, from the import of
+# the plugin module to the end of initGui
+IMPORT_BUDGET = 0.5
+
+# Loads the plugin the way QGIS does at startup against the stub iface of
+# the tests, prints the seconds it took and the deferred modules it loaded
+MEASURE = '''
+import sys
+import time
+sys.path.insert(0, 'test')
+from utilities import get_qgis_app
+QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
+loaded = set(sys.modules)
+start = time.time()
+import qgis2sps
+plugin = qgis2sps.qgis2sps(IFACE)
+plugin.initGui()
+print(time.time() - start)
+print(' '.join(name for name in %r if name in sys.modules and name not in loaded))
+''' % (DEFERRED,)
+
+try:
+    import qgis.core
+    QGIS = True
+except ImportError:
+    QGIS = False
+
+
+def module_imports(path):
+    with open(path) as f:
+        tree = ast.parse(f.read().replace('\t', '        '))
+    names = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            names.append(node.module)
+    return names
+
+
+class StartupTest(unittest.TestCase):
+    """Test QGIS starts without loading the exporter."""
+
+    def test_deferred_imports(self):
+        """Test the plugin module leaves the heavy imports to the first run."""
+        for name in ('__init__.py', 'qgis2sps.py'):
+            imports = module_imports(os.path.join(PLUGIN, name))
+            self.assertEqual([module for module in imports if module in DEFERRED], [], name)
+
+    @unittest.skipIf(not QGIS, 'needs QGIS')
+    def test_import_budget(self):
+        """Test QGIS loads the plugin within the budget and without the
+        exporter modules."""
+        runs = [subprocess.check_output([sys.executable, '-c', MEASURE], cwd=PLUGIN).splitlines()
+                for i in range(3)]
+        self.assertLess(min(float(run[0]) for run in runs), IMPORT_BUDGET)
+        for run in runs:
+            self.assertEqual(run[1:], [''])
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(StartupTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
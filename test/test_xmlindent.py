@@ -0,0 +1,61 @@
+# coding=utf-8
+"""Streaming xml indenter test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'mortenwinther.fuglsang@sweco.dk'
+__date__ = '2017-02-13'
+__copyright__ = 'Copyright 2017, Sweco'
+
+import unittest
+from cStringIO import StringIO
+
+import yattag
+import xmlindent
+
+DOCUMENTS = [
+    '<?xml version="1.0" encoding="UTF-8"?><datasources><endpoint name="ep">'
+    '<connect>localhost:5432/gis</connect><user>gis</user></endpoint>'
+    '<datasource name="ds"><table name="t"></table></datasource></datasources>',
+    '<theme><layer type="LINE"><class><name>a &amp; b</name>'
+    '<style><opacity>100</opacity><pattern></pattern></style></class></layer></theme>',
+    '<presentation><text name="x"/><columns><column format="heading">'
+    "<label>'x'</label></column></columns></presentation>",
+    '<a> mixed <b>text</b> here </a><!-- comment --><c>  </c>',
+    '<a><b></a></b><d></d>',
+    'text first<a>\n</a>',
+    '',
+]
+
+
+class XmlIndentTest(unittest.TestCase):
+    """Test the streaming indenter matches yattag.indent."""
+
+    def test_same_as_yattag(self):
+        """Test the output is byte for byte the output of yattag.indent."""
+        for document in DOCUMENTS:
+            for options in ({}, {'indent_text': True}, {'blank_is_text': True},
+                            {'indentation': '\t', 'newline': '\r\n'}):
+                self.assertEqual(xmlindent.indent(document, **options),
+                                 yattag.indent(document, **options))
+
+    def test_file_object(self):
+        """Test the output can be written to a file object in chunks."""
+        document = '<themes>' + '<theme><name>t</name></theme>' * 5000 + '</themes>'
+        f = StringIO()
+        self.assertEqual(xmlindent.indent(document, f=f), None)
+        self.assertEqual(f.getvalue(), yattag.indent(document))
+
+    def test_unrecognized_token(self):
+        """Test a document yattag can not read is refused the same way."""
+        self.assertRaises(yattag.XMLTokenError, xmlindent.indent, '<a>></a>')
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(XmlIndentTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
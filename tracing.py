@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Span names listed in the summary of a trace
+SUMMARY_SPANS = 15
+
+##################################################
+## TIMING SPANS                                 ##
+##################################################
+## A build with the trace option records nested timing spans, written as
+## complete events of the trace event format that chrome://tracing and
+## Perfetto read. Spans are only recorded while a Tracer is active, so the
+## builders cost nothing extra when nobody is tracing.
+
+class Tracer(object):
+    """Collects the spans of one build."""
+
+    def __init__(self):
+        self.events = []
+        self.local = threading.local()
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def begin(self, name, args):
+        event = {'name': name, 'ph': 'X', 'ts': time.time() * 1e6, 'pid': os.getpid(),
+                 'tid': threading.current_thread().ident, 'args': args}
+        self.stack().append(event)
+        return event
+
+    def end(self, event):
+        event['dur'] = time.time() * 1e6 - event['ts']
+        self.stack().pop()
+        self.events.append(event)
+
+    def add_time(self, key, seconds):
+        stack = self.stack()
+        if stack:
+            args = stack[-1]['args']
+            args[key] = args.get(key, 0) + seconds * 1e6
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+_active = None
+
+def active():
+    return _active
+
+def activate(tracer):
+    """Make tracer the one spans are recorded to, returns the tracer that
+    was active before.
+    """
+    global _active
+    previous = _active
+    _active = tracer
+    return previous
+
+@contextmanager
+def span(name, **args):
+    tracer = _active
+    if tracer is None:
+        yield
+        return
+    event = tracer.begin(name, args)
+    try:
+        yield
+    finally:
+        tracer.end(event)
+
+## Time spent inside the innermost span that no span of its own covers,
+## like writing a streamed file, is added to its args under key
+def add_time(key, seconds):
+    if _active is not None:
+        _active.add_time(key, seconds)
+
+def traced(function):
+    """Record every call of a function as a span named module.function."""
+    name = function.__module__ + '.' + function.__name__
+
+    def wrapper(*args, **kwargs):
+        with span(name):
+            return function(*args, **kwargs)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+##################################################
+## SUMMARY                                      ##
+##################################################
+
+def summary(path):
+    """Lines with the total time of the slowest spans of a trace file and
+    the time spent writing files, in milliseconds.
+    """
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    totals = {}
+    counts = {}
+    written = 0
+    for event in events:
+        totals[event['name']] = totals.get(event['name'], 0) + event['dur']
+        counts[event['name']] = counts.get(event['name'], 0) + 1
+        written += event['args'].get('write', 0)
+    lines = []
+    for name in sorted(totals, key=lambda name: -totals[name])[:SUMMARY_SPANS]:
+        lines.append('%10.1f ms %6d x  %s' % (totals[name] / 1000, counts[name], name))
+    lines.append('%10.1f ms           writing files' % (written / 1000))
+    return lines
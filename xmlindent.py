@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Linear time replacement for yattag.indent.
+
+yattag.indent slices the rest of the document for every token it reads and
+walks the token list twice more in TagMatcher, which makes large documents
+quadratic. This indenter reads the same tokens with the same regular
+expressions, but matches them in place by offset, so the output is byte for
+byte the output of yattag.indent. The result can be written to a file
+object in chunks instead of being returned as one string.
+"""
+import re
+
+from yattag import (Text, Comment, CData, Doctype, XMLDeclaration, Script, Style,
+                    OpenTag, SelfTag, CloseTag, XMLTokenError)
+
+TOKEN_CLASSES = (Text, Comment, CData, Doctype, XMLDeclaration, Script, Style, OpenTag, SelfTag, CloseTag)
+
+TEXT, OPEN, CLOSE, OTHER = range(4)
+
+KINDS = {'Text': TEXT, 'OpenTag': OPEN, 'CloseTag': CLOSE}
+
+# Number of output pieces collected before they are written to the file object
+CHUNK = 4096
+
+_get_token = re.compile(
+    '|'.join('(?P<%s>%s)' % (kls.__name__, kls.regex) for kls in TOKEN_CLASSES),
+    re.X | re.I | re.S
+).match
+
+def tokenize(string):
+    """Returns a (kind, start, end, tag name) tuple for every token."""
+    tokens = []
+    append = tokens.append
+    pos = 0
+    end = len(string)
+    while pos < end:
+        mobj = _get_token(string, pos)
+        if mobj is None:
+            raise XMLTokenError("Unrecognized XML token near %s" % repr(string[pos:pos + 100]))
+        # the token groups enclose all other groups, so the last group
+        # to close is the one of the token class that matched
+        name = mobj.lastgroup
+        kind = KINDS.get(name, OTHER)
+        tag_name = None
+        if kind != TEXT and kind != OTHER:
+            tag_name = mobj.group('tag_name_' + name)
+        append((kind, pos, mobj.end(), tag_name))
+        pos = mobj.end()
+    return tokens
+
+def indent(string, indentation='  ', newline='\n', indent_text=False, blank_is_text=False, f=None):
+    """Indent an xml document exactly like yattag.indent. The result is
+    returned, or written to the file object f in chunks if one is given.
+    """
+    tokens = tokenize(string)
+    count = len(tokens)
+
+    # pair open and close tags of the same name
+    matched = [False] * count
+    unmatched_open = {}
+    for i, (kind, start, end, tag_name) in enumerate(tokens):
+        if kind == OPEN:
+            unmatched_open.setdefault(tag_name, []).append(i)
+        elif kind == CLOSE:
+            opened = unmatched_open.get(tag_name)
+            if opened:
+                matched[opened.pop()] = True
+                matched[i] = True
+
+    # open tags with text directly inside them stay on one line
+    blank = [False] * count
+    contains_text = [False] * count
+    current_nodes = []
+    for i, (kind, start, end, tag_name) in enumerate(tokens):
+        if kind == OPEN and matched[i]:
+            current_nodes.append(i)
+        elif kind == CLOSE and matched[i]:
+            current_nodes.pop()
+        elif kind == TEXT:
+            blank[i] = not string[start:end].strip()
+            if (blank_is_text or not blank[i]) and current_nodes:
+                contains_text[current_nodes[-1]] = True
+
+    result = []
+    append = result.append
+    level = 0
+    sameline = 0
+    was_just_opened = False
+    tag_appeared = False
+
+    for i, (kind, start, end, tag_name) in enumerate(tokens):
+        if kind == TEXT:
+            if blank_is_text or not blank[i]:
+                if not sameline:
+                    if tag_appeared:
+                        append(newline)
+                    append(indentation * level)
+                append(string[start:end])
+                was_just_opened = False
+        elif kind == OPEN and matched[i]:
+            was_just_opened = True
+            if sameline:
+                sameline += 1
+            else:
+                if tag_appeared:
+                    append(newline)
+                append(indentation * level)
+            if not indent_text and contains_text[i]:
+                sameline = sameline or 1
+            append(string[start:end])
+            level += 1
+            tag_appeared = True
+        elif kind == CLOSE and matched[i]:
+            level -= 1
+            tag_appeared = True
+            if sameline:
+                sameline -= 1
+            elif not was_just_opened:
+                append(newline)
+                append(indentation * level)
+            append(string[start:end])
+            was_just_opened = False
+        else:
+            if not sameline:
+                if tag_appeared:
+                    append(newline)
+                append(indentation * level)
+            append(string[start:end])
+            was_just_opened = False
+            tag_appeared = True
+        if f is not None and len(result) >= CHUNK:
+            f.write(''.join(result))
+            del result[:]
+
+    if f is None:
+        return ''.join(result)
+    f.write(''.join(result))